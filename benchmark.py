@@ -0,0 +1,567 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(ROOT, 'server', 'server.py')
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def encode_message(message_dict):
+    message_bytes = json.dumps(message_dict).encode()
+    return str(len(message_bytes)).zfill(10).encode() + message_bytes
+
+def process_stats(pid):
+    # Resident memory and thread count of the server process (Linux only)
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'Threads'):
+                    stats[key] = value.strip()
+    except OSError:
+        pass
+    return stats
+
+class LoadClient:
+    """Minimal protocol client used to drive the server during benchmarks."""
+
+    def __init__(self, name):
+        self.name = name
+        self.reader = None
+        self.writer = None
+        self.received = 0
+        self.frames = 0
+        self.corrupted = False
+        self.waiters = {}
+        self.task = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.task = asyncio.ensure_future(self.read_loop())
+
+    def send(self, message_dict):
+        self.writer.write(encode_message(message_dict))
+
+    async def request(self, message_dict, response_type):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[response_type] = future
+        self.send(message_dict)
+        return await future
+
+    async def request_pending(self, response_type):
+        # Wait for the next frame of a type without sending anything
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[response_type] = future
+        return await future
+
+    async def read_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(10)
+                data = json.loads(await self.reader.readexactly(int(header)))
+                self.frames += 1
+                if data['type'] == 'message':
+                    self.received += 1
+                waiter = self.waiters.pop(data['type'], None)
+                if waiter and not waiter.done():
+                    waiter.set_result(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError:
+            # Interleaved writes on the server side garble the stream
+            self.corrupted = True
+
+    async def close(self):
+        self.writer.close()
+        self.task.cancel()
+
+async def login_client(host, port, name):
+    client = LoadClient(name)
+    await client.connect(host, port)
+    await client.request({'type': 'register', 'username': name, 'password': 'pw'}, 'register_response')
+    await client.request({'type': 'login', 'username': name, 'password': 'pw'}, 'login_response')
+    return client
+
+async def wait_for(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+async def run_load(host, port, pid, clients, senders, messages, timeout=60):
+    start = time.perf_counter()
+    connected = []
+    for i in range(clients):
+        connected.append(await login_client(host, port, f'bench{i}'))
+    connect_time = time.perf_counter() - start
+    await asyncio.sleep(0.5)
+    login_frames = sum(c.frames for c in connected)
+    stats = process_stats(pid)
+
+    # Put everyone in one room so each message fans out to every connection
+    created = await connected[0].request({'type': 'create_room', 'room_name': 'bench'}, 'room_created')
+    room_id = created['room_id']
+    for client in connected[1:]:
+        client.send({'type': 'join_room', 'room_id': room_id})
+    await asyncio.sleep(0.5)
+
+    for client in connected:
+        client.received = 0
+    expected = senders * messages * clients
+    start = time.perf_counter()
+    for n in range(messages):
+        for client in connected[:senders]:
+            client.send({'type': 'message', 'room_id': room_id, 'content': f'message {n}'})
+    completed = await wait_for(lambda: sum(c.received for c in connected) >= expected, timeout)
+    elapsed = time.perf_counter() - start
+    delivered = sum(c.received for c in connected)
+    corrupted = sum(1 for c in connected if c.corrupted)
+
+    for client in connected:
+        await client.close()
+    return {
+        'connect_time': connect_time,
+        'login_frames': login_frames,
+        'server_stats': stats,
+        'sent': senders * messages,
+        'delivered': delivered,
+        'expected': expected,
+        'elapsed': elapsed,
+        'completed': completed,
+        'corrupted': corrupted,
+    }
+
+def start_server(mode, port, workdir, extra_args=()):
+    # Each run gets a fresh working directory so chatroom.db starts empty
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(port), '--mode', mode,
+         *extra_args],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'Server in {mode} mode did not start')
+
+def bench_server(args):
+    print(f"\nServer benchmark: {args.clients} connections, {args.senders} senders x {args.messages} messages")
+    print("-" * 50)
+    for mode in args.modes:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as workdir:
+            process = start_server(mode, port, workdir, args.server_args)
+            try:
+                result = asyncio.run(run_load('127.0.0.1', port, process.pid,
+                                              args.clients, args.senders, args.messages, args.timeout))
+            finally:
+                process.terminate()
+                process.wait()
+        stats = result['server_stats']
+        print(f"\n[{mode}]")
+        print(f"  Login of {args.clients} connections: {result['connect_time']:.2f}s, "
+              f"{result['login_frames']} frames pushed to clients")
+        print(f"  Server threads: {stats.get('Threads', '?')}, RSS: {stats.get('VmRSS', '?')}")
+        status = 'complete' if result['completed'] else 'TIMED OUT'
+        print(f"  Delivered {result['delivered']}/{result['expected']} messages ({status}) "
+              f"in {result['elapsed']:.2f}s")
+        if result['corrupted']:
+            print(f"  Corrupted streams: {result['corrupted']}")
+        print(f"  Throughput: {result['sent'] / result['elapsed']:.0f} msgs/s in, "
+              f"{result['delivered'] / result['elapsed']:.0f} msgs/s out")
+
+async def chat_probe(client, room_id, stop, timings):
+    # Round trip of a chat message to our own room, to see how logins affect chat
+    while not stop.is_set():
+        start = time.perf_counter()
+        client.send({'type': 'message', 'room_id': room_id, 'content': 'probe'})
+        await client.request_pending('message')
+        timings.append(time.perf_counter() - start)
+        await asyncio.sleep(0.02)
+
+async def login_once(host, port, name):
+    client = LoadClient(name)
+    await client.connect(host, port)
+    start = time.perf_counter()
+    response = await client.request({'type': 'login', 'username': name, 'password': 'pw'}, 'login_response')
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return elapsed if response['success'] else None
+
+async def run_logins(host, port, users, concurrency):
+    # Accounts first; registering hashes too, so it is kept out of the timing
+    clients = []
+    for i in range(concurrency):
+        client = LoadClient(f'setup{i}')
+        await client.connect(host, port)
+        clients.append(client)
+    for first in range(0, users, concurrency):
+        await asyncio.gather(*(
+            client.request({'type': 'register', 'username': f'user{first + i}', 'password': 'pw'},
+                           'register_response')
+            for i, client in enumerate(clients[:users - first])
+        ))
+    for client in clients:
+        await client.close()
+
+    probe = await login_client(host, port, 'probe')
+    room_id = (await probe.request({'type': 'create_room', 'room_name': 'probe'}, 'room_created'))['room_id']
+    idle, busy = [], []
+    stop = asyncio.Event()
+    task = asyncio.ensure_future(chat_probe(probe, room_id, stop, idle))
+    await asyncio.sleep(1)
+    stop.set()
+    await task
+
+    stop = asyncio.Event()
+    task = asyncio.ensure_future(chat_probe(probe, room_id, stop, busy))
+    pending = asyncio.Semaphore(concurrency)
+
+    async def limited(name):
+        async with pending:
+            return await login_once(host, port, name)
+
+    start = time.perf_counter()
+    timings = await asyncio.gather(*(limited(f'user{i}') for i in range(users)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await task
+    await probe.close()
+    return {
+        'elapsed': elapsed,
+        'logins': [t for t in timings if t is not None],
+        'failed': sum(1 for t in timings if t is None),
+        'chat_idle': idle,
+        'chat_busy': busy,
+    }
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] if timings else 0
+
+def bench_login(args):
+    print(f"\nLogin benchmark: {args.users} users, {args.concurrency} logging in at once")
+    print("-" * 50)
+    for mode in args.modes:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as workdir:
+            process = start_server(mode, port, workdir)
+            try:
+                result = asyncio.run(run_logins('127.0.0.1', port, args.users, args.concurrency))
+            finally:
+                process.terminate()
+                process.wait()
+        logins = result['logins']
+        print(f"\n[{mode}]")
+        print(f"  {len(logins)} logins in {result['elapsed']:.2f}s: {len(logins) / result['elapsed']:.0f} logins/s"
+              + (f", {result['failed']} failed" if result['failed'] else ""))
+        print(f"  Login latency: median {percentile(logins, 0.5) * 1000:.0f} ms, "
+              f"p99 {percentile(logins, 0.99) * 1000:.0f} ms")
+        for label, timings in (('idle', result['chat_idle']), ('during logins', result['chat_busy'])):
+            print(f"  Chat round trip {label}: median {percentile(timings, 0.5) * 1000:.1f} ms, "
+                  f"p99 {percentile(timings, 0.99) * 1000:.1f} ms")
+
+def import_server_modules():
+    for path in (ROOT, os.path.join(ROOT, 'server')):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+def cpu_time(func, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - start) / repeat
+
+def drain_socket(sock):
+    try:
+        while sock.recv(1 << 16):
+            pass
+    except OSError:
+        pass
+
+def read_frames(read, frames, stream):
+    # Time reading frames from a socket pair while a thread writes the stream
+    sender, receiver = socket.socketpair()
+    writer = threading.Thread(target=sender.sendall, args=(stream,))
+    start = time.perf_counter()
+    writer.start()
+    for _ in range(frames):
+        read(receiver)
+    elapsed = time.perf_counter() - start
+    writer.join()
+    sender.close()
+    receiver.close()
+    return elapsed
+
+def bench_frames(args):
+    import_server_modules()
+    from common.protocol import V1, get_codec, read_message, FrameReader
+
+    message = {'type': 'message', 'id': 1, 'room_id': 1, 'username': 'alice',
+               'content': 'x' * args.size, 'text_color': '#000000', 'sent_at': time.time()}
+    print(f"\nFrame reader benchmark: {args.frames} chat frames of {args.size}-character messages")
+    print("-" * 50)
+    for codec in (V1, get_codec(2, 'json')):
+        stream = codec.encode(message) * args.frames
+        print(f"\n[{codec}] {len(stream) // args.frames} bytes per frame")
+        elapsed = read_frames(lambda sock: read_message(sock, codec), args.frames, stream)
+        print(f"  recv header, then body:  {args.frames / elapsed:10,.0f} frames/s, "
+              f"{2 * args.frames:,} recv calls")
+        reader = FrameReader()
+        elapsed = read_frames(lambda sock: reader.read_message(sock, codec), args.frames, stream)
+        print(f"  FrameReader:             {args.frames / elapsed:10,.0f} frames/s, "
+              f"{reader.reads:,} recv calls")
+        reader = FrameReader()
+        elapsed = read_frames(lambda sock: reader.read_frame(sock, codec), args.frames, stream)
+        print(f"  FrameReader, no decode:  {args.frames / elapsed:10,.0f} frames/s")
+
+def bench_fanout(args):
+    import_server_modules()
+    from common.protocol import V1
+    from connection import ClientConnection, ThreadedConnection
+
+    class QueueOnlyConnection(ClientConnection):
+        """Queues frames like a real connection but never writes them."""
+        def _wake(self):
+            pass
+
+    members = [QueueOnlyConnection(('bench', i), max_queue=args.repeat + 1) for i in range(args.members)]
+    message = {
+        'type': 'message',
+        'room_id': 1,
+        'username': 'bench_user',
+        'content': 'x' * args.size,
+        'text_color': '#000000'
+    }
+
+    def per_recipient():
+        # What send_to_client did for every member before: dumps, encode and header each time
+        for member in members:
+            member.send(V1.encode(message))
+
+    def encode_once():
+        frame = V1.encode(message)
+        for member in members:
+            member.send(frame)
+
+    def clear():
+        for member in members:
+            member.queue.clear()
+
+    print(f"\nFanout benchmark: {args.members}-member room, {args.size}-byte messages")
+    print("-" * 50)
+    before = cpu_time(per_recipient, args.repeat)
+    clear()
+    after = cpu_time(encode_once, args.repeat)
+    clear()
+    print(f"  Queueing, per-recipient encode: {before * 1000:.2f} ms CPU per room message")
+    print(f"  Queueing, encode once:          {after * 1000:.2f} ms CPU per room message "
+          f"({(1 - after / before) * 100:.0f}% less)")
+
+    # Socket writes: one frame per member, as each member's writer sees it
+    frame = V1.encode(message)
+    body = frame[10:]
+    left, right = socket.socketpair()
+    reader = threading.Thread(target=drain_socket, args=(right,), daemon=True)
+    reader.start()
+
+    def chunked_sends():
+        # Old send_to_client: header send, then 8 KB chunk sends
+        for _ in range(args.members):
+            left.send(frame[:10])
+            for i in range(0, len(body), 8192):
+                left.send(body[i:i + 8192])
+
+    writer = ThreadedConnection.__new__(ThreadedConnection)
+    writer.sock = left
+
+    def single_write():
+        for _ in range(args.members):
+            writer._send_frames([frame])
+
+    before = cpu_time(chunked_sends, args.repeat)
+    after = cpu_time(single_write, args.repeat)
+    chunks = 1 + (len(body) + 8191) // 8192
+    print(f"  Writing, header + chunk sends:  {before * 1000:.2f} ms CPU, {chunks * args.members} syscalls")
+    print(f"  Writing, one sendmsg per frame: {after * 1000:.2f} ms CPU, {args.members} syscalls")
+    left.close()
+    right.close()
+
+def bench_history(args):
+    import_server_modules()
+    from database import Database
+    from history import MessageLog
+
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    db = Database(os.path.join(workdir, 'chatroom.db'))
+    print(f"History benchmark: {args.messages} messages over {args.rooms} rooms")
+    print("-" * 50)
+
+    # One transaction per message, as a synchronous insert in the handler would do
+    rows = [(1_000_000_000 + i, -1, 'bench_user', 'x' * args.size, '#000000', time.time(), i + 1)
+            for i in range(args.baseline)]
+    start = time.perf_counter()
+    for row in rows:
+        db.add_messages([row])
+    elapsed = time.perf_counter() - start
+    print(f"  Commit per message:  {args.baseline / elapsed:,.0f} msgs/s ({args.baseline} messages)")
+
+    history = MessageLog(db)
+    content = 'x' * args.size
+    start = time.perf_counter()
+    for i in range(args.messages):
+        history.append(i % args.rooms, 'bench_user', content, '#000000')
+    queued = time.perf_counter() - start
+    history.flush()
+    elapsed = time.perf_counter() - start
+    stats = history.stats()
+    print(f"  Group commit:        {args.messages / elapsed:,.0f} msgs/s stored, "
+          f"{stats['batches']} transactions (avg {stats['average_batch']} rows)")
+    print(f"  append() on the message path: {queued / args.messages * 1e6:.1f} us per message")
+
+    before = history.page(0, None, 1)[0][6] // 2  # halfway back
+    start = time.perf_counter()
+    for _ in range(args.pages):
+        history.page(0, None, 50)
+    latest = (time.perf_counter() - start) / args.pages
+    start = time.perf_counter()
+    for _ in range(args.pages):
+        history.page(0, before, 50)
+    older = (time.perf_counter() - start) / args.pages
+    print(f"  get_history page of 50: {latest * 1000:.2f} ms newest, {older * 1000:.2f} ms further back")
+    history.close()
+
+def bench_search(args):
+    import random
+    import_server_modules()
+    from database import Database
+    from history import search_query
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix='chat-bench-'), 'chatroom.db')
+    db = Database(path)
+    if not db.search_available:
+        print("This SQLite build has no FTS5")
+        return
+    rng = random.Random(1)
+    # Zipf-ish vocabulary: a few very common words, a long tail of rare ones
+    vocabulary = [f'w{i}' for i in range(args.vocabulary)]
+    weights = [1 / (i + 1) for i in range(args.vocabulary)]
+    with db.reader() as conn:
+        stored = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    if stored < args.messages:
+        db.add_user('bench', 'bench')
+        with db._lock:
+            db.conn.executemany("INSERT OR IGNORE INTO rooms (room_id, room_name, creator) VALUES (?, ?, 'bench')",
+                                [(room, f'room {room}') for room in range(1, args.rooms + 1)])
+            db.conn.commit()
+        print(f"Storing {args.messages - stored:,} messages...")
+        start = time.perf_counter()
+        batch = 50000
+        for first in range(stored + 1, args.messages + 1, batch):
+            count = min(batch, args.messages + 1 - first)
+            words = rng.choices(vocabulary, weights, k=count * 8)
+            db.add_messages([(first + i, 1 + (first + i) % args.rooms, 'bench_user',
+                              ' '.join(words[i * 8:i * 8 + 8]), '#000000', 0)
+                             for i in range(count)])
+        print(f"  Inserted and indexed at {(args.messages - stored) / (time.perf_counter() - start):,.0f} msgs/s")
+    size = os.path.getsize(path) + (os.path.getsize(path + '-wal') if os.path.exists(path + '-wal') else 0)
+    print(f"Search benchmark: {args.messages:,} messages in {args.rooms} rooms, {size / 1e9:.2f} GB database")
+    print("-" * 50)
+
+    queries = [
+        ('common word', 'w1'),
+        ('rare word', f'w{args.vocabulary - 1}'),
+        ('two common words', 'w1 w2'),
+        ('common + rare word', f'w1 w{args.vocabulary // 2}'),
+        ('prefix', 'w123*'),
+    ]
+    for label, text in queries:
+        query = search_query(text)
+        for scope, room_id, public in (('one room', 1, False), ('all rooms', None, True)):
+            timings = []
+            timed_out = 0
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                try:
+                    db.search_messages(query, room_id, public, 0, 20, timeout=args.search_timeout)
+                except TimeoutError:
+                    timed_out += 1
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            median = timings[len(timings) // 2]
+            note = f" ({timed_out} cut off)" if timed_out else ""
+            print(f"  {label:<20} {scope:<10} median {median * 1000:8.1f} ms, "
+                  f"max {timings[-1] * 1000:8.1f} ms{note}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chat server benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    server_parser = subparsers.add_parser('server', help='Connections and message throughput per server mode')
+    server_parser.add_argument('--modes', nargs='+', default=['threaded', 'asyncio'])
+    server_parser.add_argument('--clients', type=int, default=200)
+    server_parser.add_argument('--senders', type=int, default=10)
+    server_parser.add_argument('--messages', type=int, default=20)
+    server_parser.add_argument('--timeout', type=float, default=60)
+    server_parser.add_argument('--server-arg', dest='server_args', action='append', default=[],
+                               help='extra argument passed to server.py (repeatable)')
+    server_parser.set_defaults(func=bench_server)
+
+    fanout_parser = subparsers.add_parser('fanout', help='CPU cost of one message to a large room')
+    fanout_parser.add_argument('--members', type=int, default=1000)
+    fanout_parser.add_argument('--size', type=int, default=200, help='message content length')
+    fanout_parser.add_argument('--repeat', type=int, default=200)
+    fanout_parser.set_defaults(func=bench_fanout)
+
+    history_parser = subparsers.add_parser('history', help='Message storage throughput and history paging')
+    history_parser.add_argument('--messages', type=int, default=100000)
+    history_parser.add_argument('--rooms', type=int, default=100)
+    history_parser.add_argument('--size', type=int, default=100, help='message content length')
+    history_parser.add_argument('--baseline', type=int, default=2000,
+                                help='messages stored one transaction at a time for comparison')
+    history_parser.add_argument('--pages', type=int, default=200)
+    history_parser.set_defaults(func=bench_history)
+
+    search_parser = subparsers.add_parser('search', help='Full-text search latency over stored messages')
+    search_parser.add_argument('--messages', type=int, default=1000000)
+    search_parser.add_argument('--rooms', type=int, default=1000)
+    search_parser.add_argument('--vocabulary', type=int, default=20000)
+    search_parser.add_argument('--repeat', type=int, default=5)
+    search_parser.add_argument('--search-timeout', type=float, default=60,
+                               help='seconds before a search is cut off (the server uses 1)')
+    search_parser.add_argument('--db', help='database file to fill or reuse (default: a scratch file)')
+    search_parser.set_defaults(func=bench_search)
+
+    login_parser = subparsers.add_parser('login', help='Login throughput with password hashing')
+    login_parser.add_argument('--modes', nargs='+', default=['threaded', 'asyncio'])
+    login_parser.add_argument('--users', type=int, default=200)
+    login_parser.add_argument('--concurrency', type=int, default=50)
+    login_parser.set_defaults(func=bench_login)
+
+    frames_parser = subparsers.add_parser('frames', help='Reading many small frames from a socket')
+    frames_parser.add_argument('--frames', type=int, default=200000)
+    frames_parser.add_argument('--size', type=int, default=40, help='message content length')
+    frames_parser.set_defaults(func=bench_frames)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -1,15 +1,303 @@
 import socket
-import json
 import threading
+import time
+import random
+import os
+import sys
+
+# The wire protocol lives in common/, shared with the server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import V1, hello_request, codec_from_reply, FrameReader
+from collections import deque
 from PyQt6.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
     QPushButton, QListWidget, QTextEdit, QLineEdit, QDialog,
     QDialogButtonBox, QMessageBox, QApplication, QListWidgetItem,
-    QColorDialog, QInputDialog, QGroupBox, QStyle, QComboBox
+    QColorDialog, QInputDialog, QGroupBox, QStyle, QComboBox,
+    QListView, QStyledItemDelegate, QAbstractItemView
 )
-from PyQt6.QtGui import QAction
-from PyQt6.QtCore import Qt, pyqtSignal
-import sys
+from PyQt6.QtGui import QAction, QColor, QFontMetrics
+from PyQt6.QtCore import Qt, pyqtSignal, QAbstractListModel, QModelIndex, QRect, QSize, QSortFilterProxyModel, QTimer
+
+CHAT_LOG_LIMIT = 5000    # messages kept per room view; the oldest are dropped past this
+HISTORY_PAGE_SIZE = 50   # older messages fetched per scroll to the top
+FRAME_INTERVAL_MS = 16   # server messages are applied to the window at most this often
+REPLAY_PAGE_SIZE = 200   # missed messages fetched per request after a reconnect
+RECONNECT_BASE_DELAY = 0.5  # seconds; the most the first reconnect attempt waits
+RECONNECT_MAX_DELAY = 30    # seconds; cap on the wait between attempts
+
+def reconnect_delay(attempt):
+    """Seconds to wait before reconnect attempt number attempt (counting from 0).
+
+    Exponential backoff with full jitter: when a server restarts, its
+    clients spread their reconnects out instead of arriving all at once.
+    """
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(attempt, 16)))
+
+# Each of these carries the whole state, so only the newest in a batch matters
+SNAPSHOT_TYPES = ('room_state', 'online_users', 'friends_list')
+ROOM_DELTA_TYPES = ('room_added', 'room_removed', 'user_count_changed', 'moderators_changed')
+
+def coalesce_messages(batch):
+    """Reduce a batch of server messages to what the window has to apply.
+
+    Snapshots superseded later in the batch are dropped, along with room
+    deltas that came before the last room_state (it already includes them).
+    Runs of chat messages are folded into one {'type': 'messages'} entry so
+    they reach the chat log in a single insert. Everything else is kept in
+    order.
+    """
+    latest = {data['type']: i for i, data in enumerate(batch) if data['type'] in SNAPSHOT_TYPES}
+    room_state = latest.get('room_state', -1)
+    items = []
+    for i, data in enumerate(batch):
+        kind = data['type']
+        if kind in latest and latest[kind] != i:
+            continue
+        if kind in ROOM_DELTA_TYPES and i < room_state:
+            continue
+        if kind == 'message':
+            if items and items[-1]['type'] == 'messages':
+                items[-1]['messages'].append(data)
+            else:
+                items.append({'type': 'messages', 'messages': [data]})
+        else:
+            items.append(data)
+    return items
+
+class ChatLogModel(QAbstractListModel):
+    """Messages of the current room in seq order, capped at `limit`.
+
+    Live messages go in at the bottom and push the oldest out once the log
+    is full. History pages go in at the top, but only while there is room,
+    so scrolling back never evicts what just arrived. Messages relayed from
+    other servers can arrive slightly out of order; merge_messages puts
+    them in their place.
+    """
+
+    def __init__(self, limit=CHAT_LOG_LIMIT, parent=None):
+        super().__init__(parent)
+        self.limit = limit
+        self.messages = deque()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"{message['username']}: {message['content']}"
+        if role == Qt.ItemDataRole.ForegroundRole:
+            return QColor(message.get('text_color') or '#000000')
+        if role == Qt.ItemDataRole.UserRole:
+            return message
+        return None
+
+    def append_messages(self, messages):
+        if not messages:
+            return
+        overflow = len(self.messages) + len(messages) - self.limit
+        if overflow > 0:
+            messages = messages[-self.limit:]
+            overflow = min(overflow, len(self.messages))
+            if overflow:
+                self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+                for _ in range(overflow):
+                    self.messages.popleft()
+                self.endRemoveRows()
+        first = len(self.messages)
+        self.beginInsertRows(QModelIndex(), first, first + len(messages) - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+
+    def prepend_messages(self, messages):
+        """Add older messages (oldest first) above what is shown; returns how many fit."""
+        oldest = self.oldest_seq()
+        if oldest is not None:
+            messages = [message for message in messages if message['seq'] < oldest]
+        messages = messages[max(0, len(messages) - (self.limit - len(self.messages))):]
+        if messages:
+            self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+            self.messages.extendleft(reversed(messages))
+            self.endInsertRows()
+        return len(messages)
+
+    def merge_messages(self, messages):
+        """Put messages in seq order among those shown; returns how many were new."""
+        messages = sorted(messages, key=lambda message: message['seq'])
+        newest = self.newest_seq()
+        if newest is None or (messages and messages[0]['seq'] > newest):
+            # The usual case: everything is newer than what is shown
+            self.append_messages(messages)
+            return len(messages)
+        added = 0
+        for message in messages:
+            # Late messages belong near the bottom, so search from there
+            row = len(self.messages)
+            while row > 0 and self.messages[row - 1]['seq'] > message['seq']:
+                row -= 1
+            if row > 0 and self.messages[row - 1]['seq'] == message['seq']:
+                continue
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.messages.insert(row, message)
+            self.endInsertRows()
+            added += 1
+        overflow = len(self.messages) - self.limit
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            for _ in range(overflow):
+                self.messages.popleft()
+            self.endRemoveRows()
+        return added
+
+    def oldest_seq(self):
+        return self.messages[0]['seq'] if self.messages else None
+
+    def newest_seq(self):
+        return self.messages[-1]['seq'] if self.messages else None
+
+    def is_full(self):
+        return len(self.messages) >= self.limit
+
+    def clear(self):
+        self.beginResetModel()
+        self.messages.clear()
+        self.endResetModel()
+
+class KeyedListModel(QAbstractListModel):
+    """A list whose rows are looked up by key, changed with minimal model signals.
+
+    set_items() diffs a full snapshot against the current rows: it removes
+    what is gone, signals dataChanged for what changed, and appends what is
+    new, instead of resetting the list. Row order is arrival order; views
+    sort and filter through a QSortFilterProxyModel (see sorted_view).
+    """
+
+    def __init__(self, key, display, decoration=None, parent=None):
+        super().__init__(parent)
+        self.key = key                # item -> key
+        self.display = display        # item -> text
+        self.decoration = decoration  # item -> icon or None
+        self.items = []
+        self.rows = {}                # {key: row}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        item = self.items[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.display(item)
+        if role == Qt.ItemDataRole.DecorationRole and self.decoration is not None:
+            return self.decoration(item)
+        if role == Qt.ItemDataRole.UserRole:
+            return item
+        return None
+
+    def get(self, key):
+        row = self.rows.get(key)
+        return None if row is None else self.items[row]
+
+    def upsert(self, item):
+        key = self.key(item)
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.items)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.items.append(item)
+            self.rows[key] = row
+            self.endInsertRows()
+        else:
+            self.items[row] = item
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def remove(self, key):
+        row = self.rows.get(key)
+        if row is not None:
+            self._remove_rows([row])
+
+    def _remove_rows(self, rows):
+        # Highest first, one signal per run of adjacent rows
+        rows = sorted(rows, reverse=True)
+        i = 0
+        while i < len(rows):
+            last = first = rows[i]
+            i += 1
+            while i < len(rows) and rows[i] == first - 1:
+                first = rows[i]
+                i += 1
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.items[first:last + 1]
+            self.endRemoveRows()
+        self.rows = {self.key(item): row for row, item in enumerate(self.items)}
+
+    def set_items(self, items):
+        new = {self.key(item): item for item in items}
+        gone = [row for key, row in self.rows.items() if key not in new]
+        if gone:
+            self._remove_rows(gone)
+        added = []
+        for key, item in new.items():
+            row = self.rows.get(key)
+            if row is None:
+                added.append(item)
+            elif self.items[row] != item:
+                self.items[row] = item
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+        if added:
+            first = len(self.items)
+            self.beginInsertRows(QModelIndex(), first, first + len(added) - 1)
+            for row, item in enumerate(added, first):
+                self.items.append(item)
+                self.rows[self.key(item)] = row
+            self.endInsertRows()
+
+def sorted_view(model, parent=None):
+    """A case-insensitive, sorted and filterable proxy over model."""
+    proxy = QSortFilterProxyModel(parent)
+    proxy.setSourceModel(model)
+    proxy.setSortCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+    proxy.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+    proxy.setDynamicSortFilter(True)  # keeps sorting as rows change, without a full resort
+    proxy.sort(0)
+    return proxy
+
+class ChatMessageDelegate(QStyledItemDelegate):
+    """Draws a message in its sender's colour, wrapped to the view's width."""
+
+    PADDING = 4
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+
+    def _text_rect(self, option, text, width):
+        flags = Qt.AlignmentFlag.AlignLeft | Qt.TextFlag.TextWordWrap
+        bounds = QRect(0, 0, max(1, width - 2 * self.PADDING), 1 << 20)
+        return QFontMetrics(option.font).boundingRect(bounds, flags, text)
+
+    def sizeHint(self, option, index):
+        width = self.view.viewport().width()
+        rect = self._text_rect(option, index.data(Qt.ItemDataRole.DisplayRole), width)
+        return QSize(width, rect.height() + self.PADDING)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        painter.setPen(index.data(Qt.ItemDataRole.ForegroundRole))
+        painter.setFont(option.font)
+        rect = option.rect.adjusted(self.PADDING, self.PADDING // 2, -self.PADDING, -self.PADDING // 2)
+        painter.drawText(rect, Qt.AlignmentFlag.AlignLeft | Qt.TextFlag.TextWordWrap,
+                         index.data(Qt.ItemDataRole.DisplayRole))
+        painter.restore()
 
 class FriendRequestDialog(QDialog):
     def __init__(self, username, parent=None):
@@ -323,19 +611,39 @@ class UserProfileDialog(QDialog):
             self.color_btn.setStyleSheet(f'background-color: {self.text_color}')
 
 class ChatClient(QMainWindow):
-    message_received = pyqtSignal(dict)
+    messages_ready = pyqtSignal()
     connection_status = pyqtSignal(bool)
+    reconnect_finished = pyqtSignal(object)
 
     def __init__(self):
         super().__init__()
         self.socket = None
+        self.codec = V1
         self.connected = False
         self.username = None
         self.current_room = None
+        self.rooms = {}              # {room_id: room info}, kept current by deltas
+        self.room_seq = None         # seq of the last room directory change applied
+        self.room_resync_pending = False
+        self.history_more = False    # the server has older messages for current_room
+        self.history_pending = False # a get_history request is in flight
+        self.history_anchor = None   # distance from the bottom to keep after older messages load
+        # Messages decoded by the network thread wait in the inbox until the
+        # GUI thread drains it; one signal wakes it per batch, not per message
+        self.inbox = []
+        self.inbox_lock = threading.Lock()
+        self.drain_scheduled = False
+        self.last_drain = 0.0
+        self.backlog = deque()       # drained messages not yet applied
+        self.resume_token = None     # from login_response; lets a reconnect skip the login
+        self.reconnect_attempts = 0  # failed attempts since the connection dropped
+        self.reconnect_pending = False  # a reconnect is scheduled or connecting
+        self.replayed = 0            # missed messages fetched since the last resume
         
         self.init_ui()
-        self.message_received.connect(self.handle_server_message)
+        self.messages_ready.connect(self.schedule_drain)
         self.connection_status.connect(self.handle_connection_status)
+        self.reconnect_finished.connect(self.handle_reconnect)
 
     def init_ui(self):
         self.setWindowTitle('Chat Client')
@@ -357,8 +665,22 @@ class ChatClient(QMainWindow):
         # Rooms list
         rooms_group = QGroupBox("Rooms")
         rooms_layout = QVBoxLayout()
-        self.rooms_list = QListWidget()
-        self.rooms_list.itemClicked.connect(self.room_selected)
+        private_icon = self.style().standardIcon(QStyle.StandardPixmap.SP_MessageBoxQuestion)
+        self.room_model = KeyedListModel(
+            key=lambda room: room['id'],
+            display=self.room_label,
+            decoration=lambda room: private_icon if room['type'] == 'private' else None,
+            parent=self
+        )
+        self.room_proxy = sorted_view(self.room_model, self)
+        room_search = QLineEdit()
+        room_search.setPlaceholderText('Search rooms...')
+        room_search.textChanged.connect(self.room_proxy.setFilterFixedString)
+        rooms_layout.addWidget(room_search)
+        self.rooms_list = QListView()
+        self.rooms_list.setModel(self.room_proxy)
+        self.rooms_list.setUniformItemSizes(True)
+        self.rooms_list.clicked.connect(self.room_selected)
         rooms_layout.addWidget(self.rooms_list)
         
         # Room controls
@@ -377,8 +699,17 @@ class ChatClient(QMainWindow):
         # Online users list
         users_group = QGroupBox("Online Users")
         users_layout = QVBoxLayout()
-        self.users_list = QListWidget()
-        self.users_list.itemClicked.connect(self.user_clicked)
+        self.user_model = KeyedListModel(key=lambda username: username, display=lambda username: username,
+                                         parent=self)
+        self.user_proxy = sorted_view(self.user_model, self)
+        user_search = QLineEdit()
+        user_search.setPlaceholderText('Search users...')
+        user_search.textChanged.connect(self.user_proxy.setFilterFixedString)
+        users_layout.addWidget(user_search)
+        self.users_list = QListView()
+        self.users_list.setModel(self.user_proxy)
+        self.users_list.setUniformItemSizes(True)
+        self.users_list.clicked.connect(self.user_clicked)
         users_layout.addWidget(self.users_list)
         users_group.setLayout(users_layout)
         left_layout.addWidget(users_group)
@@ -387,9 +718,19 @@ class ChatClient(QMainWindow):
         right_panel = QWidget()
         right_layout = QVBoxLayout(right_panel)
         
-        # Chat display
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
+        # Chat display: the view only lays out and paints the rows on screen
+        self.chat_log = ChatLogModel(CHAT_LOG_LIMIT, self)
+        self.chat_display = QListView()
+        self.chat_display.setModel(self.chat_log)
+        self.chat_display.setItemDelegate(ChatMessageDelegate(self.chat_display))
+        self.chat_display.setWordWrap(True)
+        self.chat_display.setResizeMode(QListView.ResizeMode.Adjust)
+        self.chat_display.setLayoutMode(QListView.LayoutMode.Batched)
+        self.chat_display.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.chat_display.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        scroll_bar = self.chat_display.verticalScrollBar()
+        scroll_bar.valueChanged.connect(self.chat_scrolled)
+        scroll_bar.rangeChanged.connect(self.chat_range_changed)
         right_layout.addWidget(self.chat_display)
         
         # Message input
@@ -433,27 +774,54 @@ class ChatClient(QMainWindow):
             else:
                 self.statusBar.showMessage('Connected | Not logged in')
                 self.statusBar.setStyleSheet("background-color: #FFB6C1;")  # Light red
+        elif self.reconnect_attempts:
+            self.statusBar.showMessage(f'Connection lost | Reconnecting (attempt {self.reconnect_attempts})...')
+            self.statusBar.setStyleSheet("background-color: #FFE4B5;")  # Light orange
         else:
             self.statusBar.showMessage('Not connected to server')
             self.statusBar.setStyleSheet("background-color: #FFB6C1;")  # Light red
 
+    def open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        sock.connect(('98.237.241.248', 5000))
+        return sock
+
+    def open_connection(self):
+        # Connect and negotiate the protocol; raises if the server can't be
+        # reached. Returns (socket, frames, codec) and leaves self alone, so
+        # a reconnect thread never swaps them under the GUI thread
+        sock = self.open_socket()
+        try:
+            frames, codec = self.negotiate_protocol(sock)
+        except Exception:
+            sock.close()
+            raise
+        if codec is None:
+            # A slow server may still answer the hello and switch to v2, so
+            # this socket can't go on in v1; start over without a hello
+            sock.close()
+            sock = self.open_socket()
+            frames = FrameReader()
+            codec = V1
+        sock.settimeout(None)
+        return sock, frames, codec
+
+    def start_receiving(self):
+        self.connected = True
+        self.update_status_bar()  # Update status after connection
+        
+        # Start listening for server messages
+        thread = threading.Thread(target=self.receive_messages, args=(self.socket, self.frames))
+        thread.daemon = True
+        thread.start()
+
     def connect_to_server(self):
         try:
             print("Attempting to connect to server...")
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)
-            self.socket.connect(('98.237.241.248', 5000))
-            self.socket.settimeout(None)
-            self.connected = True
-            self.update_status_bar()  # Update status after connection
-            
+            self.socket, self.frames, self.codec = self.open_connection()
             print("Connected successfully")
-            
-            # Start listening for server messages
-            thread = threading.Thread(target=self.receive_messages)
-            thread.daemon = True
-            thread.start()
-            
+            self.start_receiving()
             return True
         except socket.timeout:
             QMessageBox.critical(self, 'Error', 'Connection timed out. Server might be offline.')
@@ -465,67 +833,106 @@ class ChatClient(QMainWindow):
             QMessageBox.critical(self, 'Error', f'Could not connect to server: {str(e)}')
             return False
 
-    def receive_messages(self):
-        while self.connected:
+    def negotiate_protocol(self, sock):
+        # Offer protocol v2 before anything else is sent. Servers that predate
+        # it never answer; after a short wait the codec comes back as None
+        # and the caller reconnects to speak v1.
+        sock.sendall(V1.encode(hello_request()))
+        sock.settimeout(2)
+        # One reader for the whole connection: frames that arrive right
+        # behind the reply stay buffered for receive_messages
+        frames = FrameReader()
+        try:
+            reply = frames.read_message(sock, V1)
+        except socket.timeout:
+            print("Server did not answer hello, using protocol v1")
+            return frames, None
+        finally:
+            sock.settimeout(10)
+        codec = codec_from_reply(reply)
+        print(f"Negotiated {codec}")
+        return frames, codec
+
+    def receive_messages(self, sock, frames):
+        # Bound to one connection: after a reconnect the old thread must not
+        # read from the new socket or report the old one as lost
+        while self.connected and sock is self.socket:
             try:
-                # First receive the message length
-                length_header = self.socket.recv(10)
-                if not length_header:
-                    raise ConnectionError("Server closed connection")
-                
-                message_length = int(length_header.decode().strip())
-                
-                # Initialize buffer for receiving data
-                data_buffer = bytearray()
-                bytes_received = 0
-                
-                # Receive the full message
-                while bytes_received < message_length:
-                    chunk_size = min(8192, message_length - bytes_received)
-                    chunk = self.socket.recv(chunk_size)
-                    if not chunk:
-                        raise ConnectionError("Connection closed while receiving message")
-                    data_buffer.extend(chunk)
-                    bytes_received += len(chunk)
-                
-                # Decode and parse the complete message
-                message = data_buffer.decode()
-                data = json.loads(message)
-                self.message_received.emit(data)
+                data = frames.read_message(sock, self.codec)
+                with self.inbox_lock:
+                    self.inbox.append(data)
+                    if self.drain_scheduled:
+                        continue
+                    self.drain_scheduled = True
+                self.messages_ready.emit()
                 
             except Exception as e:
-                print(f"Error receiving message: {e}")
-                self.connected = False
-                self.connection_status.emit(False)
+                if sock is self.socket:
+                    print(f"Error receiving message: {e}")
+                    self.connected = False
+                    self.connection_status.emit(False)
                 break
 
+    def schedule_drain(self):
+        # Apply at most once per frame; messages arriving in between join the batch
+        wait = FRAME_INTERVAL_MS - (time.monotonic() - self.last_drain) * 1000
+        if wait > 0:
+            QTimer.singleShot(int(wait) + 1, self.drain_inbox)
+        else:
+            self.drain_inbox()
+
+    def drain_inbox(self):
+        with self.inbox_lock:
+            batch, self.inbox = self.inbox, []
+            self.drain_scheduled = False
+        self.last_drain = time.monotonic()
+        # A dialog opened while applying runs a nested event loop that can
+        # drain again; sharing the backlog keeps messages in arrival order
+        self.backlog.extend(coalesce_messages(batch))
+        while self.backlog:
+            self.handle_server_message(self.backlog.popleft())
+
     def handle_server_message(self, data):
         try:
-            print(f"Received message from server: {data['type']}")
-            print(f"Message data: {data}")  # Add debug logging
-            if data['type'] == 'message':
-                self.display_message(data['username'], data['content'], data.get('text_color', '#000000'))
+            if data['type'] == 'messages':
+                messages = [message for message in data['messages'] if message['room_id'] == self.current_room]
+                if messages:
+                    self.display_messages(messages)
+            elif data['type'] == 'message':
+                if data['room_id'] == self.current_room:
+                    self.display_messages([data])
+            elif data['type'] == 'room_joined':
+                if data['room_id'] == self.current_room:
+                    self.request_history()
+            elif data['type'] == 'history':
+                if data['room_id'] == self.current_room:
+                    if data.get('after') is not None:
+                        self.show_missed(data['messages'], data.get('has_more', False))
+                    else:
+                        self.show_history(data['messages'], data.get('has_more', False))
             elif data['type'] == 'room_state':
-                print(f"Updating rooms with: {data['rooms']}")  # Add debug logging
-                print(f"Rooms list enabled state before update: {self.rooms_list.isEnabled()}")  # Add debug logging
+                self.rooms = {room['id']: room for room in data['rooms']}
+                self.room_seq = data.get('seq')
+                self.room_resync_pending = False
                 self.update_rooms(data['rooms'])
-                print(f"Room list now has {self.rooms_list.count()} items")  # Add debug logging
-                print(f"Rooms list enabled state after update: {self.rooms_list.isEnabled()}")  # Add debug logging
+            elif data['type'] in ('room_added', 'room_removed', 'user_count_changed', 'moderators_changed'):
+                self.apply_room_delta(data)
             elif data['type'] == 'online_users':
                 self.update_online_users(data['users'])
             elif data['type'] == 'login_response':
                 if data.get('success'):
-                    print("Login successful, enabling rooms list")  # Add debug logging
                     self.username = data.get('username')
+                    self.resume_token = data.get('resume_token')
                     self.message_input.setEnabled(True)
                     self.rooms_list.setEnabled(True)
-                    print(f"Rooms list enabled state after login: {self.rooms_list.isEnabled()}")  # Add debug logging
                     self.update_status_bar()
                     # Request friends list after login
                     self.send_to_server({'type': 'get_friends'})
                     QMessageBox.information(self, 'Success', 'Logged in successfully!')
                 else:
                     QMessageBox.warning(self, 'Error', 'Login failed')
+            elif data['type'] == 'resume_response':
+                self.resume_session(data)
             elif data['type'] == 'friends_list':
                 self.friends_panel.update_friends(data['friends'])
             elif data['type'] == 'friend_request':
@@ -545,7 +952,7 @@ class ChatClient(QMainWindow):
                 if self.current_room == data['room_id']:
                     self.current_room = None
                     self.message_input.setEnabled(False)
-                    self.chat_display.clear()
+                    self.clear_chat()
             elif data['type'] == 'register_response':
                 if data.get('success'):
                     QMessageBox.information(self, 'Success', 'Registration successful! You can now login.')
@@ -556,7 +963,7 @@ class ChatClient(QMainWindow):
                 if room_id is not None:
                     # Automatically select and join the new room
                     self.current_room = room_id
-                    self.chat_display.clear()
+                    self.clear_chat()
                     self.message_input.setEnabled(True)
                     print(f"Automatically joined room {room_id}")
                 QMessageBox.information(self, 'Success', 
@@ -579,18 +986,117 @@ class ChatClient(QMainWindow):
             elif data['type'] == 'error':
                 QMessageBox.warning(self, 'Error', data['message'])
         except Exception as e:
-            print(f"Error handling server message: {e}")
-            print(f"Message data: {data}")
+            print(f"Error handling server message {data.get('type')}: {e}")
 
     def handle_connection_status(self, connected):
         if not connected:
+            if self.reconnect_pending:
+                # The receive thread and a failed send can both report the
+                # same drop; only the first one starts a reconnect
+                return
             self.connected = False
-            self.username = None
+            self.room_seq = None
             self.message_input.setEnabled(False)
             self.rooms_list.setEnabled(False)
+            try:
+                # shutdown wakes a receive thread still blocked on the socket
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+            if self.resume_token is not None:
+                # Logged in: reconnect in the background and resume the session
+                self.reconnect_pending = True
+                self.schedule_reconnect()
+                return
+            self.username = None
             self.update_status_bar()  # Update status on disconnect
             QMessageBox.warning(self, 'Disconnected', 'Lost connection to server')
 
+    def schedule_reconnect(self):
+        delay = reconnect_delay(self.reconnect_attempts)
+        self.reconnect_attempts += 1
+        self.update_status_bar()
+        QTimer.singleShot(int(delay * 1000), self.start_reconnect)
+
+    def start_reconnect(self):
+        # Connecting can block for seconds, so it runs off the GUI thread
+        threading.Thread(target=self.reconnect, daemon=True).start()
+
+    def reconnect(self):
+        # The new connection goes back through the signal; only the GUI
+        # thread replaces self.socket, self.frames and self.codec
+        try:
+            connection = self.open_connection()
+        except Exception as e:
+            print(f"Reconnect attempt {self.reconnect_attempts} failed: {e}")
+            self.reconnect_finished.emit(None)
+            return
+        self.reconnect_finished.emit(connection)
+
+    def handle_reconnect(self, connection):
+        if connection is None:
+            self.schedule_reconnect()
+            return
+        self.reconnect_pending = False
+        self.socket, self.frames, self.codec = connection
+        self.start_receiving()
+        self.send_to_server({'type': 'resume', 'token': self.resume_token})
+
+    def resume_session(self, data):
+        # The server restored our user and, if it still exists and we aren't
+        # banned, our room; presence and the room list follow as usual
+        self.reconnect_attempts = 0
+        if not data.get('success'):
+            self.resume_token = None
+            self.username = None
+            self.current_room = None
+            self.clear_chat()
+            self.update_status_bar()
+            QMessageBox.warning(self, 'Disconnected', 'Your session has expired, please log in again')
+            return
+        # The token we resumed with is used up; the next reconnect needs this one
+        self.resume_token = data.get('resume_token')
+        self.username = data['username']
+        self.rooms_list.setEnabled(True)
+        self.update_status_bar()
+        self.send_to_server({'type': 'get_friends'})
+        room_id = data.get('room_id')
+        if room_id is None:
+            self.current_room = None
+            self.clear_chat()
+            return
+        self.message_input.setEnabled(True)
+        self.replayed = 0
+        newest = self.chat_log.newest_seq()
+        if room_id != self.current_room or newest is None:
+            self.current_room = room_id
+            self.clear_chat()
+            self.request_history()
+        else:
+            self.request_missed(newest)
+
+    def request_missed(self, after):
+        self.send_to_server({'type': 'get_history', 'room_id': self.current_room, 'after': after,
+                             'limit': REPLAY_PAGE_SIZE})
+
+    def show_missed(self, messages, has_more):
+        # Messages sent while we were disconnected, oldest first. Live ones
+        # may already be shown below them; merge_messages keeps seq order
+        scroll_bar = self.chat_display.verticalScrollBar()
+        at_bottom = scroll_bar.value() >= scroll_bar.maximum()
+        self.chat_log.merge_messages(messages)
+        self.replayed += len(messages)
+        if at_bottom:
+            self.chat_display.scrollToBottom()
+        if has_more and messages:
+            if self.replayed >= CHAT_LOG_LIMIT:
+                # Missed more than the log holds: just show the newest page
+                self.clear_chat()
+                self.request_history()
+            else:
+                self.request_missed(messages[-1]['seq'])
+
     def send_to_server(self, message_dict):
         if not self.connected:
             print("Not connected to server")
@@ -609,21 +1115,8 @@ class ChatClient(QMainWindow):
                     pic_size = len(message_dict['profile_pic']) if message_dict['profile_pic'] else 0
                     print(f"Profile picture data size: {pic_size} bytes")
             
-            # Convert to JSON and encode
-            json_str = json.dumps(message_dict)
-            message_bytes = json_str.encode()
-            
-            # First send the message length
-            message_length = len(message_bytes)
-            length_header = str(message_length).zfill(10).encode()
-            self.socket.send(length_header)
-            
-            # Then send the actual message in chunks
-            chunk_size = 8192
-            for i in range(0, len(message_bytes), chunk_size):
-                chunk = message_bytes[i:i + chunk_size]
-                self.socket.send(chunk)
-            
+            # Header and body go out as one frame
+            self.socket.sendall(self.codec.encode(message_dict))
             return True
         except Exception as e:
             print(f"Error sending message: {e}")
@@ -757,38 +1250,100 @@ class ChatClient(QMainWindow):
             QMessageBox.critical(self, 'Error', 
                                f'Failed to send registration request: {str(e)}')
 
+    @staticmethod
+    def room_label(room):
+        # For private rooms, don't show user count
+        if room['type'] == 'private':
+            return f"{room['name']} (Private)"
+        return f"{room['name']} ({room.get('user_count', 0)} users)"
+
     def update_rooms(self, rooms):
-        print(f"Updating rooms list with {len(rooms)} rooms")  # Add debug logging
-        self.rooms_list.clear()
-        for room in rooms:
-            print(f"Processing room: {room}")  # Add debug logging
-            # For private rooms, don't show user count
-            if room['type'] == 'private':
-                item = QListWidgetItem(f"{room['name']} (Private)")
-            else:
-                item = QListWidgetItem(f"{room['name']} ({room.get('user_count', 0)} users)")
-            # Store full room info in item data
-            item.setData(Qt.ItemDataRole.UserRole, room)
-            if room['type'] == 'private':
-                item.setIcon(self.style().standardIcon(QStyle.StandardPixmap.SP_MessageBoxQuestion))
-            self.rooms_list.addItem(item)
-        print(f"Room list updated, now has {self.rooms_list.count()} items")  # Add debug logging
+        # Copies, so the diff sees changes made later to self.rooms
+        self.room_model.set_items([dict(room) for room in rooms])
 
-    def update_online_users(self, users):
-        self.users_list.clear()
-        for username in users:
-            self.users_list.addItem(username)
+    def apply_room_delta(self, delta):
+        # Deltas sent before our snapshot are already reflected in it
+        if self.room_seq is None or delta['seq'] <= self.room_seq:
+            return
+        if delta['seq'] != self.room_seq + 1:
+            # We missed a change; ask for a fresh snapshot and drop deltas until it arrives
+            if not self.room_resync_pending:
+                print(f"Room state gap ({self.room_seq} -> {delta['seq']}), resyncing")
+                self.room_resync_pending = True
+                self.send_to_server({'type': 'get_room_state'})
+            return
 
-    def display_message(self, username, content, text_color='#000000'):
-        message = f'<span style="color: {text_color}">{username}: {content}</span>'
-        self.chat_display.append(message)
+        self.room_seq = delta['seq']
+        if delta['type'] == 'room_added':
+            room = delta['room']
+            self.rooms[room['id']] = room
+            self.room_model.upsert(dict(room))
+        elif delta['type'] == 'room_removed':
+            self.rooms.pop(delta['room_id'], None)
+            self.room_model.remove(delta['room_id'])
+        elif delta['room_id'] in self.rooms:
+            room = self.rooms[delta['room_id']]
+            if delta['type'] == 'user_count_changed':
+                room['user_count'] = delta['user_count']
+            else:
+                room['moderators'] = delta['moderators']
+            self.room_model.upsert(dict(room))
 
-    def room_selected(self, item):
-        room_data = item.data(Qt.ItemDataRole.UserRole)
+    def update_online_users(self, users):
+        self.user_model.set_items(users)
+
+    def clear_chat(self):
+        self.chat_log.clear()
+        self.history_more = False
+        self.history_pending = False
+        self.history_anchor = None
+
+    def display_messages(self, messages):
+        # Follow new messages only if the user is already at the bottom
+        scroll_bar = self.chat_display.verticalScrollBar()
+        at_bottom = scroll_bar.value() >= scroll_bar.maximum()
+        self.chat_log.merge_messages(messages)
+        if at_bottom:
+            self.chat_display.scrollToBottom()
+
+    def request_history(self):
+        request = {'type': 'get_history', 'room_id': self.current_room, 'limit': HISTORY_PAGE_SIZE}
+        oldest = self.chat_log.oldest_seq()
+        if self.history_more and oldest is not None:
+            request['before'] = oldest
+        self.history_pending = self.send_to_server(request)
+
+    def show_history(self, messages, has_more):
+        # Live messages may have arrived before the history reply; only
+        # messages older than everything shown are added
+        self.history_pending = False
+        first_page = self.chat_log.rowCount() == 0
+        scroll_bar = self.chat_display.verticalScrollBar()
+        distance_from_bottom = scroll_bar.maximum() - scroll_bar.value()
+        added = self.chat_log.prepend_messages(messages)
+        self.history_more = has_more and added > 0 and not self.chat_log.is_full()
+        if first_page:
+            self.chat_display.scrollToBottom()
+        elif added:
+            self.history_anchor = distance_from_bottom
+
+    def chat_scrolled(self, value):
+        # Scrolled to the top: fetch the page before the oldest message shown
+        if value == 0 and self.history_more and not self.history_pending:
+            self.request_history()
+
+    def chat_range_changed(self, minimum, maximum):
+        # Older messages went in above; keep the same messages on screen
+        if self.history_anchor is not None:
+            self.chat_display.verticalScrollBar().setValue(maximum - self.history_anchor)
+            self.history_anchor = None
+
+    def room_selected(self, index):
+        room_data = index.data(Qt.ItemDataRole.UserRole)
         room_id = room_data['id']  # Get room_id from the room data dictionary
         if room_id != self.current_room:
             self.current_room = room_id
-            self.chat_display.clear()  # Clear previous chat messages
+            self.clear_chat()  # Clear previous chat messages
             
             # Check if room is private and prompt for password
             message = {
@@ -858,8 +1413,8 @@ class ChatClient(QMainWindow):
             print(f"Error showing user profile: {e}")
             QMessageBox.critical(self, 'Error', f'Failed to show user profile: {str(e)}')
 
-    def user_clicked(self, item):
-        username = item.text()
+    def user_clicked(self, index):
+        username = index.data(Qt.ItemDataRole.UserRole)
         if username != self.username:
             self.show_user_profile(username)
 
@@ -868,14 +1423,10 @@ class ChatClient(QMainWindow):
             QMessageBox.warning(self, 'Error', 'Please select a room first')
             return
 
-        # Find room info from rooms list
-        for i in range(self.rooms_list.count()):
-            item = self.rooms_list.item(i)
-            room_data = item.data(Qt.ItemDataRole.UserRole)
-            if room_data['id'] == self.current_room:
-                dialog = RoomManagementDialog(self.current_room, room_data, self.username, self)
-                dialog.exec()
-                break
+        room_data = self.room_model.get(self.current_room)
+        if room_data is not None:
+            dialog = RoomManagementDialog(self.current_room, room_data, self.username, self)
+            dialog.exec()
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
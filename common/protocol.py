@@ -0,0 +1,248 @@
+"""Wire protocol shared by the chat client and server.
+
+Version 1 frames are a 10-byte zero-padded ASCII length header followed by a
+UTF-8 JSON body. Every connection starts out speaking v1, so older clients
+keep working unchanged.
+
+A peer that knows about v2 sends a 'hello' message (as a v1 frame) listing
+what it supports. The server answers with its own 'hello' naming the chosen
+settings, and both sides switch to v2 right after that reply:
+
+- a 4-byte big-endian length prefix; the top bit flags a compressed body
+- the body encoded as msgpack when both sides have it installed, else JSON
+- bodies above COMPRESSION_THRESHOLD bytes zlib-compressed, if negotiated
+"""
+import json
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+V1_HEADER_SIZE = 10
+V2_HEADER = struct.Struct('>I')
+COMPRESSED_FLAG = 0x80000000
+LENGTH_MASK = 0x7FFFFFFF
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 1  # chat payloads are small; favour speed over ratio
+READ_BUFFER_SIZE = 16384  # FrameReader buffer; grows while a larger frame is read
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # largest body accepted; the header comes from the peer
+
+class ProtocolError(ValueError):
+    pass
+
+class Codec:
+    """Turns messages into frames and back for one negotiated protocol setup.
+
+    Codecs are shared between connections (see get_codec), so a broadcast
+    can encode once per distinct codec rather than once per recipient.
+    """
+
+    def __init__(self, version=1, encoding='json', compression=None):
+        if version == 1 and (encoding != 'json' or compression):
+            raise ProtocolError("Protocol v1 only supports uncompressed JSON")
+        if encoding == 'msgpack' and msgpack is None:
+            raise ProtocolError("msgpack is not installed")
+        self.version = version
+        self.encoding = encoding
+        self.compression = compression
+        self.header_size = V1_HEADER_SIZE if version == 1 else V2_HEADER.size
+
+    def __repr__(self):
+        return f"Codec(v{self.version}, {self.encoding}, {self.compression or 'uncompressed'})"
+
+    def dumps(self, message):
+        if self.encoding == 'msgpack':
+            return msgpack.packb(message, use_bin_type=True)
+        return json.dumps(message).encode()
+
+    def loads(self, payload):
+        if self.encoding == 'msgpack':
+            try:
+                return msgpack.unpackb(payload, raw=False)
+            except Exception as e:
+                raise ProtocolError(f"Invalid msgpack payload: {e}")
+        if isinstance(payload, memoryview):
+            payload = str(payload, 'utf-8')  # json.loads doesn't take memoryviews
+        return json.loads(payload)
+
+    def encode(self, message):
+        """Return one complete frame (header + body) for message."""
+        body = self.dumps(message)
+        if self.version == 1:
+            return str(len(body)).zfill(V1_HEADER_SIZE).encode() + body
+
+        length = len(body)
+        if self.compression == 'zlib' and length > COMPRESSION_THRESHOLD:
+            compressed = zlib.compress(body, COMPRESSION_LEVEL)
+            if len(compressed) < length:
+                return V2_HEADER.pack(len(compressed) | COMPRESSED_FLAG) + compressed
+        return V2_HEADER.pack(length) + body
+
+    def parse_header(self, header):
+        """Return (body_length, compressed) for a frame header.
+
+        Raises ProtocolError for a malformed header or a body longer than
+        MAX_FRAME_SIZE, before anything is allocated for it.
+        """
+        if self.version == 1:
+            header = bytes(header)
+            if not header.isdigit():
+                raise ProtocolError(f"Invalid frame header: {header!r}")
+            length, compressed = int(header), False
+        else:
+            value, = V2_HEADER.unpack(header)
+            length, compressed = value & LENGTH_MASK, bool(value & COMPRESSED_FLAG)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        return length, compressed
+
+    def decode(self, body, compressed=False):
+        if compressed:
+            # Bounded, so a small compressed frame can't expand without limit
+            inflater = zlib.decompressobj()
+            try:
+                body = inflater.decompress(body, MAX_FRAME_SIZE)
+            except zlib.error as e:
+                raise ProtocolError(f"Invalid compressed frame: {e}")
+            if inflater.unconsumed_tail:
+                raise ProtocolError(f"Compressed frame expands past {MAX_FRAME_SIZE} bytes")
+        return self.loads(body)
+
+_codecs = {}
+
+def get_codec(version=1, encoding='json', compression=None):
+    key = (version, encoding, compression)
+    if key not in _codecs:
+        _codecs[key] = Codec(version, encoding, compression)
+    return _codecs[key]
+
+V1 = get_codec()
+
+def available_encodings():
+    # Preferred first
+    return ['msgpack', 'json'] if msgpack is not None else ['json']
+
+def hello_request():
+    """The hello a client sends (as a v1 frame) to offer protocol v2."""
+    return {
+        'type': 'hello',
+        'versions': [2, 1],
+        'encodings': available_encodings(),
+        'compression': ['zlib']
+    }
+
+def negotiate(hello):
+    """Pick the codec for a client's hello. Falls back to v1 if nothing matches."""
+    if 2 not in hello.get('versions', []):
+        return V1
+    offered = hello.get('encodings', [])
+    encoding = next((e for e in available_encodings() if e in offered), None)
+    if encoding is None:
+        return V1
+    compression = 'zlib' if 'zlib' in hello.get('compression', []) else None
+    return get_codec(2, encoding, compression)
+
+def hello_reply(codec):
+    return {
+        'type': 'hello',
+        'version': codec.version,
+        'encoding': codec.encoding,
+        'compression': codec.compression
+    }
+
+def codec_from_reply(reply):
+    return get_codec(reply.get('version', 1), reply.get('encoding', 'json'), reply.get('compression'))
+
+def recv_exactly(sock, size):
+    """Read exactly size bytes from a blocking socket.
+
+    Memory is taken as the bytes arrive, not all at once for a size that
+    came from the peer.
+    """
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(min(size - len(buffer), READ_BUFFER_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed while receiving message")
+        buffer += chunk
+    return buffer
+
+class FrameReader:
+    """Reads frames from a blocking socket through one reusable buffer.
+
+    Each recv_into fills as much of the buffer as the socket has ready, and
+    the frames in it are handed out one per call with no further syscalls.
+    Frames are decoded straight from memoryview slices of the buffer, so
+    nothing is copied per frame. The codec is passed per call, so a
+    connection can switch codecs right after a hello even if the frames
+    behind it already arrived.
+
+    The buffer grows when a frame doesn't fit, at most doubling per receive,
+    so its size follows the data that has actually arrived rather than the
+    length a header claims. It shrinks back once it is empty. A view
+    returned by read_frame is only valid until the next call.
+    """
+
+    def __init__(self, size=READ_BUFFER_SIZE):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not yet handed out
+        self.end = 0    # end of the received data
+        self.reads = 0  # recv_into calls so far
+
+    def _fill(self, sock, needed):
+        # Receive more, making sure needed bytes from self.start will fit
+        buffered = self.end - self.start
+        if buffered == 0:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size and needed <= self.size:
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+        if self.start + needed > len(self.buffer):
+            if buffered == len(self.buffer):
+                buffer = bytearray(min(needed, 2 * len(self.buffer)))
+                buffer[:buffered] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+                self.start, self.end = 0, buffered
+            elif self.start:
+                # Move the partial frame to the front (memoryview copies handle overlap)
+                self.view[:buffered] = self.view[self.start:self.end]
+                self.start, self.end = 0, buffered
+        count = sock.recv_into(self.view[self.end:])
+        if not count:
+            raise ConnectionError("Connection closed while receiving message")
+        self.reads += 1
+        self.end += count
+
+    def read_frame(self, sock, codec):
+        """Return (whole frame as a memoryview, compressed), receiving only if needed."""
+        header_size = codec.header_size
+        while self.end - self.start < header_size:
+            self._fill(sock, header_size)
+        length, compressed = codec.parse_header(self.view[self.start:self.start + header_size])
+        size = header_size + length
+        while self.end - self.start < size:
+            self._fill(sock, size)
+        frame = self.view[self.start:self.start + size]
+        self.start += size
+        return frame, compressed
+
+    def read_message(self, sock, codec):
+        """Read and decode the next frame."""
+        frame, compressed = self.read_frame(sock, codec)
+        return codec.decode(frame[codec.header_size:], compressed)
+
+def read_message(sock, codec):
+    """Read and decode one frame from a blocking socket."""
+    length, compressed = codec.parse_header(recv_exactly(sock, codec.header_size))
+    return codec.decode(recv_exactly(sock, length), compressed)
+
+async def read_message_async(reader, codec):
+    """Read and decode one frame from an asyncio StreamReader."""
+    length, compressed = codec.parse_header(await reader.readexactly(codec.header_size))
+    return codec.decode(await reader.readexactly(length), compressed)
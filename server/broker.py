@@ -0,0 +1,344 @@
+"""Event bus linking chat server processes into one chat service.
+
+A server publishes events (room messages, presence, room changes) through a
+Broker and gets every other node's events back through its callback. Any
+transport works as long as it implements the Broker interface:
+
+- BrokerClient talks to a BrokerHub over a Unix or TCP socket. The hub is the
+  reference broker: `--workers` starts one on a Unix socket, and for nodes on
+  several hosts run it on its own with `python server/broker.py`.
+
+Nodes prove they belong to the cluster with a shared secret in their hello;
+anyone who can publish can fake chat, bans and presence.
+
+Events are dicts with a 'kind' and the publishing 'node'. Delivery is best
+effort and in order per publisher; a node that goes away is announced to the
+others with a 'node_down' event. Chat messages are the exception to "every
+other node": the broker numbers them per room (Broker.sequence) and sends
+them to every node, the publisher included. A BrokerClient whose connection drops
+reconnects on its own and hands its server a local 'reconnected' event, so
+the server can announce itself again.
+"""
+import os
+import sys
+import hmac
+import time
+import random
+import socket
+import threading
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import get_codec, available_encodings, FrameReader
+from connection import ThreadedConnection, DROP_OLDEST
+from log import get_logger, setup_logging, LOG_LEVELS
+
+log = get_logger('broker')
+
+# Every node runs the same code, so use the best encoding available here
+BUS_CODEC = get_codec(2, available_encodings()[0])
+BUS_QUEUE_SIZE = 100000
+HELLO_TIMEOUT = 5            # seconds a new connection has to say hello
+RECONNECT_BASE_DELAY = 0.5   # seconds before the first reconnect attempt
+RECONNECT_MAX_DELAY = 30     # cap on the wait between attempts
+SECRET_ENV = 'CHAT_BROKER_SECRET'  # where --broker-secret is read from by default
+SEQUENCED_KIND = 'room_message'    # events the hub numbers before relaying them
+
+def parse_address(address):
+    """Return (socket family, address) for 'tcp://host:port', 'unix://path' or a bare path."""
+    if address.startswith('tcp://'):
+        host, _, port = address[len('tcp://'):].rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"Invalid broker address: {address}")
+        return socket.AF_INET, (host, int(port))
+    if address.startswith('unix://'):
+        address = address[len('unix://'):]
+    return socket.AF_UNIX, address
+
+class Broker:
+    """Interface between a ChatServer and the rest of the cluster."""
+
+    node_id = None
+
+    def start(self, on_event):
+        """Connect and call on_event(event) for every event from other nodes."""
+        raise NotImplementedError
+
+    def publish(self, kind, **fields):
+        """Send an event to every other node."""
+        raise NotImplementedError
+
+    def sequence(self, room_id, message, floor):
+        """Have message numbered in room_id's order across the cluster.
+
+        It comes back to every node, this one included, as a 'room_message'
+        event with message['seq'] set above floor, the last seq this node has
+        seen there. Returns False if it can't be sent right now.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {'node': self.node_id}
+
+    def close(self):
+        pass
+
+class BrokerHub:
+    """Reference broker: relays events between nodes connected over sockets.
+
+    Each node opens one connection and says hello with its node id and the
+    cluster secret; connections with a wrong or missing secret are closed.
+    A second hello for the same node id replaces (and closes) its older
+    connection. Every event a node publishes is forwarded as-is to all other
+    nodes. When a node's current connection drops the hub tells the others
+    with 'node_down', so they can forget its users.
+
+    The hub is also the cluster's sequencer: it gives each room_message the
+    room's next seq and sends it to every node. Its counters start empty and
+    are raised to each request's floor, so a restarted hub carries on from
+    what the nodes have seen.
+    """
+
+    def __init__(self, address, secret):
+        if not secret:
+            raise ValueError("The broker needs a shared secret")
+        self.address = address
+        self.secret = secret.encode('utf-8')
+        self.family, self.bind_address = parse_address(address)
+        self.nodes = {}  # {node_id: connection}
+        self.room_seqs = {}  # {room_id: last seq handed out}
+        self.lock = threading.Lock()
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            os.unlink(self.bind_address)
+        self.listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.bind_address)
+        self.listener.listen()
+
+    def serve_forever(self):
+        try:
+            while True:
+                sock, _ = self.listener.accept()
+                if self.family == socket.AF_INET:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                thread = threading.Thread(target=self.handle_node, args=(sock,), daemon=True)
+                thread.start()
+        except OSError:
+            pass  # listener closed
+
+    def handle_node(self, sock):
+        # Hub-side links reuse the client connection queues, so a busy
+        # node can't hold up delivery to the others
+        link = ThreadedConnection(sock, self.address, BUS_QUEUE_SIZE, DROP_OLDEST)
+        link.codec = BUS_CODEC
+        node_id = None
+        frames = FrameReader()
+        try:
+            sock.settimeout(HELLO_TIMEOUT)
+            hello = frames.read_message(sock, BUS_CODEC)
+            sock.settimeout(None)
+            secret = str(hello.get('secret', '')).encode('utf-8')
+            if hello.get('kind') != 'hello' or not hmac.compare_digest(secret, self.secret):
+                log.warning("Rejected a broker connection with a bad hello")
+                return
+            node_id = hello['node']
+            with self.lock:
+                # A node that reconnected before we noticed its old link died
+                stale = self.nodes.get(node_id)
+                self.nodes[node_id] = link
+            if stale is not None:
+                stale.close()
+            log.info("Node %s connected", node_id)
+            sequenced = SEQUENCED_KIND.encode('utf-8')
+            while True:
+                # Forward the raw frame. Only frames that may be chat messages
+                # get decoded (bus frames are never compressed, so the kind
+                # appears in the bytes); others are relayed untouched
+                frame, compressed = frames.read_frame(sock, BUS_CODEC)
+                frame = bytes(frame)
+                if sequenced in frame:
+                    event = BUS_CODEC.decode(frame[BUS_CODEC.header_size:], compressed)
+                    if event.get('kind') == SEQUENCED_KIND:
+                        self.sequence(event)
+                        continue
+                self.relay(link, frame)
+        except (ConnectionError, OSError, ValueError, KeyError, AttributeError, TypeError):
+            pass
+        finally:
+            with self.lock:
+                # Only the node's current link speaks for it; a replaced one
+                # going away doesn't mean the node did
+                current = node_id is not None and self.nodes.get(node_id) is link
+                if current:
+                    del self.nodes[node_id]
+            link.close()
+            if current:
+                log.info("Node %s disconnected", node_id)
+                self.relay(None, BUS_CODEC.encode({'kind': 'node_down', 'node': node_id}))
+
+    def sequence(self, event):
+        room_id = event['room_id']
+        floor = event.pop('floor', 0)
+        with self.lock:
+            seq = max(self.room_seqs.get(room_id, 0), floor) + 1
+            self.room_seqs[room_id] = seq
+            event['message']['seq'] = seq
+            frame = BUS_CODEC.encode(event)
+            # Queued under the lock, so every node gets a room's messages in seq order
+            for link in self.nodes.values():
+                link.send(frame)
+
+    def relay(self, sender, frame):
+        with self.lock:
+            links = [link for link in self.nodes.values() if link is not sender]
+        for link in links:
+            link.send(frame)
+
+    def close(self):
+        self.listener.close()
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.bind_address)
+            except OSError:
+                pass
+
+class BrokerClient(Broker):
+    """A node's connection to a BrokerHub.
+
+    publish() only queues the event: a writer thread sends it, through the
+    same bounded DROP_OLDEST queue the hub uses for its links, so a slow or
+    stalled hub never holds up the server's handlers or event loop.
+
+    If the connection drops it reconnects with backoff. Events published
+    meanwhile are dropped (delivery is best effort), and the hub has told
+    the other nodes this one is down, so once back the server gets a local
+    'reconnected' event to announce its state again.
+    """
+
+    def __init__(self, address, node_id, secret):
+        self.address = address
+        self.node_id = node_id
+        self.secret = secret
+        self.link = None  # ThreadedConnection to the hub
+        self.connected = False
+        self.closed = False
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(BUS_CODEC.encode({'kind': 'hello', 'node': self.node_id, 'secret': self.secret}))
+        except OSError:
+            sock.close()
+            raise
+        link = ThreadedConnection(sock, self.address, BUS_QUEUE_SIZE, DROP_OLDEST)
+        link.codec = BUS_CODEC
+        self.link = link
+        self.connected = True
+
+    def start(self, on_event):
+        self._connect()
+        thread = threading.Thread(target=self._receive_loop, args=(on_event,), daemon=True)
+        thread.start()
+
+    def publish(self, kind, **fields):
+        event = {'kind': kind, 'node': self.node_id, **fields}
+        link = self.link
+        # A write error closes the link; the receive loop then reconnects
+        if not self.connected or not link.send(BUS_CODEC.encode(event)):
+            self.dropped += 1
+            return
+        self.published += 1
+
+    def sequence(self, room_id, message, floor):
+        if not self.connected:
+            return False
+        self.publish(SEQUENCED_KIND, room_id=room_id, message=message, floor=floor)
+        return True
+
+    def _receive_loop(self, on_event):
+        while True:
+            frames = FrameReader()
+            link = self.link
+            try:
+                while True:
+                    event = frames.read_message(link.sock, BUS_CODEC)
+                    self.received += 1
+                    try:
+                        on_event(event)
+                    except Exception:
+                        log.exception("Error handling broker event %s", event.get('kind'))
+            except (ConnectionError, OSError, ValueError) as e:
+                if self.closed:
+                    return
+                log.error("Lost connection to broker: %s", e)
+            self.connected = False
+            link.close()
+            if not self._reconnect():
+                return
+            try:
+                on_event({'kind': 'reconnected', 'node': self.node_id})
+            except Exception:
+                log.exception("Error handling broker reconnect")
+
+    def _reconnect(self):
+        # Jittered so a restarted hub isn't hit by every node at the same moment
+        delay = RECONNECT_BASE_DELAY
+        while not self.closed:
+            time.sleep(random.uniform(delay / 2, delay))
+            try:
+                self._connect()
+            except OSError as e:
+                log.warning("Reconnecting to broker failed: %s", e)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            self.reconnects += 1
+            log.info("Reconnected to broker")
+            return True
+        return False
+
+    def stats(self):
+        link = self.link
+        return {'node': self.node_id, 'connected': self.connected, 'published': self.published,
+                'received': self.received, 'dropped': self.dropped, 'reconnects': self.reconnects,
+                'queue': link.stats() if link is not None else None}
+
+    def close(self):
+        self.closed = True
+        self.connected = False
+        if self.link is not None:
+            self.link.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chat cluster broker')
+    parser.add_argument('--listen', default='tcp://127.0.0.1:5100',
+                        help="address to listen on: tcp://host:port or unix:///path")
+    parser.add_argument('--secret', default=os.environ.get(SECRET_ENV),
+                        help=f"secret every node must present (default: ${SECRET_ENV})")
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.secret:
+        sys.exit(f"Set a cluster secret with --secret or ${SECRET_ENV}")
+    listener = setup_logging(args.log_level)
+    hub = BrokerHub(args.listen, args.secret)
+    log.info("Broker listening on %s", args.listen)
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.close()
+        log.info("Broker shutdown")
+        listener.stop()
@@ -0,0 +1,230 @@
+import abc
+import socket
+import threading
+import asyncio
+from collections import deque
+from common.protocol import V1
+
+# What to do when a connection's outbound queue is full
+DROP_OLDEST = 'drop_oldest'  # discard the oldest queued frame
+DISCONNECT = 'disconnect'    # drop the slow consumer
+COALESCE = 'coalesce'        # replace superseded snapshots, then discard the oldest frame
+QUEUE_POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+# Most frames a writer hands to the kernel in one call (well under IOV_MAX)
+WRITE_BATCH = 64
+
+class ClientConnection(abc.ABC):
+    """A connected client with a bounded outbound queue.
+
+    Handlers never write to the socket directly. send() queues an encoded
+    frame and returns immediately; a per-connection writer drains the queue,
+    so a client with a full TCP window only ever delays itself.
+
+    Frames may carry a coalesce key (e.g. 'online_users'). Under the
+    coalesce policy a newer frame with the same key replaces the queued one
+    in place, since only the latest snapshot matters to the client.
+    """
+
+    def __init__(self, addr, max_queue=1000, policy=DROP_OLDEST):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.addr = addr
+        self.codec = V1  # until the client negotiates something else
+        self.session_token = None  # digest of the resume token, once logged in
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue = deque()  # entries are [key, frame]
+        self.keyed = {}       # {key: queued entry}, used by the coalesce policy
+        self.closed = False
+        self.slow_consumer = False
+        self.max_depth = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+
+    def send(self, frame, key=None):
+        """Queue an encoded frame. Returns False if the connection is closing."""
+        with self._lock:
+            if self.closed:
+                return False
+
+            if key is not None and self.policy == COALESCE:
+                entry = self.keyed.get(key)
+                if entry is not None:
+                    entry[1] = frame
+                    self.coalesced += 1
+                    return True
+
+            if len(self.queue) >= self.max_queue:
+                if self.policy == DISCONNECT:
+                    self.slow_consumer = True
+                    self.closed = True
+                    self._abort()
+                    return False
+                self._next_frame()
+                self.dropped += 1
+
+            entry = [key, frame]
+            self.queue.append(entry)
+            if key is not None and self.policy == COALESCE:
+                self.keyed[key] = entry
+            if len(self.queue) > self.max_depth:
+                self.max_depth = len(self.queue)
+        self._wake()
+        return True
+
+    def _next_frame(self):
+        # Caller holds self._lock and has checked that the queue is not empty
+        entry = self.queue.popleft()
+        key = entry[0]
+        if key is not None and self.keyed.get(key) is entry:
+            del self.keyed[key]
+        return entry[1]
+
+    def _next_batch(self):
+        # Caller holds self._lock; takes up to WRITE_BATCH queued frames
+        return [self._next_frame() for _ in range(min(len(self.queue), WRITE_BATCH))]
+
+    def depth(self):
+        return len(self.queue)
+
+    def stats(self):
+        return {
+            'depth': len(self.queue),
+            'max_depth': self.max_depth,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self.queue.clear()
+            self.keyed.clear()
+        self._wake()
+        self._close_transport()
+
+    @abc.abstractmethod
+    def _wake(self):
+        """Tell the writer there is something to do."""
+
+    @abc.abstractmethod
+    def _abort(self):
+        """Drop the connection so its reader runs the disconnect path."""
+
+    @abc.abstractmethod
+    def _close_transport(self):
+        """Release the transport."""
+
+class ThreadedConnection(ClientConnection):
+    """Connection for the threaded server: a writer thread drains the queue."""
+
+    def __init__(self, sock, addr, max_queue=1000, policy=DROP_OLDEST):
+        super().__init__(addr, max_queue, policy)
+        self.sock = sock
+        self._ready = threading.Condition(self._lock)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self._ready:
+                while not self.queue and not self.closed:
+                    self._ready.wait()
+                if self.closed:
+                    return
+                frames = self._next_batch()
+            try:
+                self._send_frames(frames)
+            except OSError:
+                with self._lock:
+                    self.closed = True
+                self._abort()
+                return
+
+    def _send_frames(self, frames):
+        """Write queued frames with as few syscalls as possible."""
+        if not hasattr(self.sock, 'sendmsg'):
+            # No scatter-gather (Windows): one sendall of the joined frames
+            self.sock.sendall(frames[0] if len(frames) == 1 else b''.join(frames))
+            return
+        buffers = [memoryview(frame) for frame in frames]
+        first = 0
+        while first < len(buffers):
+            sent = self.sock.sendmsg(buffers[first:])
+            # Skip past fully written frames and trim a partially written one
+            while sent:
+                remaining = len(buffers[first])
+                if sent >= remaining:
+                    sent -= remaining
+                    first += 1
+                else:
+                    buffers[first] = buffers[first][sent:]
+                    sent = 0
+
+    def _wake(self):
+        with self._ready:
+            self._ready.notify()
+
+    def _abort(self):
+        # Unblocks the handler thread's recv so it runs the normal disconnect path
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close_transport(self):
+        # shutdown first: a writer blocked in sendmsg on a full buffer, or a
+        # reader in recv, only wakes up for that, not for close
+        self._abort()
+        self.sock.close()
+
+class AsyncConnection(ClientConnection):
+    """Connection for the asyncio server: a writer task drains the queue."""
+
+    def __init__(self, writer, addr, max_queue=1000, policy=DROP_OLDEST):
+        super().__init__(addr, max_queue, policy)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._task = self.loop.create_task(self._write_loop())
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self.queue and not self.closed:
+                    self._ready.clear()
+                    await self._ready.wait()
+                with self._lock:
+                    if self.closed:
+                        return
+                    frames = self._next_batch()
+                # One call per batch (Python 3.12+ turns it into a single sendmsg)
+                self.writer.writelines(frames)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            with self._lock:
+                self.closed = True
+            self._abort()
+
+    def _in_loop(self, callback):
+        # Queue operations may come from other threads; transport calls may not
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback)
+
+    def _wake(self):
+        self._in_loop(self._ready.set)
+
+    def _abort(self):
+        # The reader sees the connection drop and runs the normal disconnect path
+        self._in_loop(self.writer.transport.abort)
+
+    def _close_transport(self):
+        self._in_loop(self.writer.close)
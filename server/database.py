@@ -1,27 +1,89 @@
 import sqlite3
 import threading
+import queue
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import base64
+from collections import OrderedDict
+from log import get_logger
+
+log = get_logger('database')
+
+PROFILE_CACHE_SIZE = 10000  # users whose (bio, pronouns, text_color) stay in memory
+MODERATOR_SEPARATOR = '\x1f'  # joins moderator names in the directory query
+DB_PATH = 'chatroom.db'
+READER_POOL_SIZE = 4  # read-only connections shared by all handler threads
+SEARCH_TIMEOUT = 1.0  # seconds before a search is cut off
 
 class Database:
     _instance = None
-    _lock = threading.Lock()
-    _local = threading.local()
 
-    def __init__(self):
-        # Initialize thread-local storage
-        self._local.conn = None
+    def __init__(self, path=DB_PATH, readers=READER_POOL_SIZE, profile_cache_size=PROFILE_CACHE_SIZE):
+        self.path = path
+        # One writer connection; every write goes through it under self._lock.
+        # Reads borrow a connection from a bounded pool and run in parallel
+        # (WAL lets readers proceed while a write is in progress)
+        self._lock = threading.Lock()
+        self.conn = self._connect()
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self._readers = queue.Queue()
+        self._reader_count = 0
+        self._max_readers = readers
+        self._reader_lock = threading.Lock()
+        # LRU cache of user profiles, read on every chat message for text_color.
+        # Has its own lock so cache hits never wait for the database lock
+        self._profiles = OrderedDict()  # {username: (bio, pronouns, text_color)}
+        self._profile_cache_size = profile_cache_size
+        self._profile_lock = threading.Lock()
+        self._profile_hits = 0
+        self._profile_misses = 0
+        self._profile_version = 0  # bumped by every write-through; see get_user_profile
+        # Friend lists of online users, loaded by the first get_friends and
+        # dropped when the user goes offline. Friend requests update both
+        # users' entries, so friend lists are served without SQL
+        self._friends = {}  # {username: {friend: status}}
+        self._friend_lock = threading.Lock()
+        self._friend_hits = 0
+        self._friend_misses = 0
+        self._friend_version = 0  # same role as _profile_version
+        # What join_room checks, per room: (room_type, password, {banned usernames}).
+        # Loaded on first use and kept current by create_room, ban_user and
+        # delete_room. Its own lock, so join checks never wait behind a write
+        self._room_access = None
+        self._access_lock = threading.Lock()
+        self._access_version = 0  # bumped by invalidate_room_access, which takes no lock
         # Create tables when database is initialized
         self.create_tables()
 
-    @property
-    def conn(self):
-        # Get or create connection for current thread
-        if not hasattr(self._local, 'conn') or self._local.conn is None:
-            self._local.conn = sqlite3.connect('chatroom.db')
-            # Enable foreign key support
-            self._local.conn.execute('PRAGMA foreign_keys = ON')
-        return self._local.conn
+    def _connect(self, read_only=False):
+        # Connections are shared between threads, never used by two at once
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        # Enable foreign key support
+        conn.execute('PRAGMA foreign_keys = ON')
+        # WAL only needs a sync at checkpoints to stay consistent
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA cache_size = -16000')  # 16 MB page cache
+        conn.execute('PRAGMA temp_store = MEMORY')
+        if read_only:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection, opening one if the pool isn't full yet."""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._reader_lock:
+                opened = self._reader_count < self._max_readers
+                if opened:
+                    self._reader_count += 1
+            conn = self._connect(read_only=True) if opened else self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
 
     def create_tables(self):
         with self._lock:
@@ -95,10 +157,111 @@ class Database:
                 FOREIGN KEY (user2) REFERENCES users (username)
             )
             ''')
+            # The primary key covers lookups by user1; get_friends also needs user2
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_friends_user2
+            ON friends (user2)
+            ''')
+
+            # Chat history. Ids are handed out by allocate_ids before the row
+            # is written, so live messages can carry their id. Ids come in
+            # blocks per server, so a room's order is its seq (see MessageLog)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                room_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                content TEXT NOT NULL,
+                text_color TEXT,
+                sent_at REAL NOT NULL,
+                seq INTEGER
+            )
+            ''')
+            cursor.execute('PRAGMA table_info(messages)')
+            if 'seq' not in [column[1] for column in cursor.fetchall()]:
+                # History from before sequence numbers: number it in id order
+                cursor.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+                cursor.execute('''
+                UPDATE messages SET seq = numbered.seq
+                FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY id) AS seq
+                      FROM messages) AS numbered
+                WHERE messages.id = numbered.id
+                ''')
+            cursor.execute('DROP INDEX IF EXISTS idx_messages_room')
+            cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_room_seq
+            ON messages (room_id, seq)
+            ''')
+
+            # Resumable sessions: a client that reconnects with the token gets
+            # its user and room back without logging in again. Only a digest
+            # of the token is stored; see passwords.new_resume_token
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                room_id INTEGER,
+                expires_at REAL NOT NULL,
+                FOREIGN KEY (username) REFERENCES users (username)
+            )
+            ''')
+
+            # Next free id per sequence, shared by every server using this file
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS id_blocks (
+                name TEXT PRIMARY KEY,
+                next_id INTEGER NOT NULL
+            )
+            ''')
+
+            self.conn.commit()
+            self.search_available = self._create_search_index()
+
+    def _create_search_index(self):
+        # Caller holds self._lock. Full-text index over message content, kept
+        # in sync by triggers; the text itself stays in the messages table.
+        # room_id is indexed too, so a one-room search is an index intersection
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+        existed = cursor.fetchone() is not None
+        try:
+            cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(content, room_id, content='messages', content_rowid='id', tokenize='unicode61')
+            ''')
+        except sqlite3.OperationalError as e:
+            log.warning("Message search disabled, SQLite has no FTS5: %s", e)
+            return False
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, room_id)
+            VALUES ('delete', old.id, old.content, old.room_id);
+        END
+        ''')
+        self.conn.commit()
+        if not existed:
+            # Index history stored before search existed
+            self._rebuild_search_index()
+        return True
+
+    def _rebuild_search_index(self):
+        self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        self.conn.commit()
 
+    def rebuild_search_index(self):
+        """Re-index every stored message, e.g. after a bulk import."""
+        with self._lock:
+            self._rebuild_search_index()
+            self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
             self.conn.commit()
 
     def add_user(self, username, password):
+        # password is the hash to store, see passwords.hash_password
         with self._lock:
             cursor = self.conn.cursor()
             try:
@@ -107,14 +270,85 @@ class Database:
                 self.conn.commit()
                 return True
             except sqlite3.IntegrityError:
+                self.conn.rollback()  # don't leave the shared writer mid-transaction
                 return False
 
-    def verify_user(self, username, password):
+    def get_password(self, username):
+        """The stored password hash (plaintext for rows older than hashing), or None."""
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT password FROM users WHERE username = ?', (username,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def set_password(self, username, password, previous):
+        """Replace a stored password, unless it changed since it was read as previous."""
         with self._lock:
             cursor = self.conn.cursor()
-            cursor.execute('SELECT password FROM users WHERE username = ?', (username,))
+            cursor.execute('UPDATE users SET password = ? WHERE username = ? AND password = ?',
+                           (password, username, previous))
+            self.conn.commit()
+            return cursor.rowcount > 0
+
+    def get_passwords(self):
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT username, password FROM users')
+            return cursor.fetchall()
+
+    def create_session(self, token, username, expires_at):
+        with self._lock:
+            cursor = self.conn.cursor()
+            try:
+                # Expired sessions are cleared out as new ones are made
+                cursor.execute('DELETE FROM sessions WHERE expires_at < ?', (time.time(),))
+                cursor.execute('INSERT INTO sessions (token, username, expires_at) VALUES (?, ?, ?)',
+                               (token, username, expires_at))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()  # don't leave the shared writer mid-transaction
+                raise
+
+    def resume_session(self, token, new_token):
+        """Move an unexpired session over to new_token; returns its (username, room_id), or None.
+
+        The old token stops working. The session keeps the expiry it got at login.
+        """
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('UPDATE sessions SET token = ? WHERE token = ? AND expires_at >= ?',
+                           (new_token, token, time.time()))
+            if cursor.rowcount == 0:
+                self.conn.commit()
+                return None
+            cursor.execute('SELECT username, room_id FROM sessions WHERE token = ?', (new_token,))
             result = cursor.fetchone()
-            return result and result[0] == password
+            self.conn.commit()
+            return result
+
+    def set_session_room(self, token, room_id):
+        with self._lock:
+            self.conn.execute('UPDATE sessions SET room_id = ? WHERE token = ?', (room_id, token))
+            self.conn.commit()
+
+    def rooms_with_sessions(self, room_ids):
+        """The room_ids that an unexpired session would resume into."""
+        room_ids = list(room_ids)
+        if not room_ids:
+            return set()
+        placeholders = ', '.join('?' * len(room_ids))
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT DISTINCT room_id FROM sessions '
+                           f'WHERE expires_at >= ? AND room_id IN ({placeholders})',
+                           (time.time(), *room_ids))
+            return {row[0] for row in cursor.fetchall()}
+
+    def user_exists(self, username):
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM users WHERE username = ?', (username,))
+            return cursor.fetchone() is not None
 
     def update_user_status(self, username, is_online):
         with self._lock:
@@ -126,6 +360,19 @@ class Database:
             ''', (is_online, datetime.now(), username))
             self.conn.commit()
 
+    def set_user_statuses(self, changes):
+        """Write many (is_online, last_login, username) changes in one transaction."""
+        with self._lock:
+            self.conn.executemany('UPDATE users SET is_online = ?, last_login = ? WHERE username = ?',
+                                  changes)
+            self.conn.commit()
+
+    def reset_online_status(self):
+        """Mark everyone offline; run at startup, before any user can log in."""
+        with self._lock:
+            self.conn.execute('UPDATE users SET is_online = 0 WHERE is_online = 1')
+            self.conn.commit()
+
     def update_profile(self, username, profile_pic=None, text_color=None):
         with self._lock:
             cursor = self.conn.cursor()
@@ -136,24 +383,33 @@ class Database:
                 cursor.execute('UPDATE users SET text_color = ? WHERE username = ?',
                              (text_color, username))
             self.conn.commit()
+            if text_color:
+                self._update_cached_profile(username, text_color=text_color)
 
     def create_room(self, room_name, creator, room_type='public', password=None, description=None):
         with self._lock:
             cursor = self.conn.cursor()
-            cursor.execute('''
-            INSERT INTO rooms (room_name, creator, room_type, password, description)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (room_name, creator, room_type, password, description))
-            room_id = cursor.lastrowid
-            # Make creator a moderator
-            cursor.execute('INSERT INTO room_moderators (room_id, username) VALUES (?, ?)',
-                         (room_id, creator))
-            self.conn.commit()
+            try:
+                cursor.execute('''
+                INSERT INTO rooms (room_name, creator, room_type, password, description)
+                VALUES (?, ?, ?, ?, ?)
+                ''', (room_name, creator, room_type, password, description))
+                room_id = cursor.lastrowid
+                # Make creator a moderator
+                cursor.execute('INSERT INTO room_moderators (room_id, username) VALUES (?, ?)',
+                             (room_id, creator))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()  # don't leave the shared writer mid-transaction
+                raise
+            with self._access_lock:
+                if self._room_access is not None:
+                    self._room_access[room_id] = (room_type, password, set())
             return room_id
 
     def get_rooms(self, include_private=False):
-        with self._lock:
-            cursor = self.conn.cursor()
+        with self.reader() as conn:
+            cursor = conn.cursor()
             # Always get all rooms, both public and private
             cursor.execute('''
             SELECT room_id, room_name, creator, room_type, description 
@@ -161,22 +417,63 @@ class Database:
             ''')
             return cursor.fetchall()
 
+    def get_room_directory(self):
+        """Every room with its moderators, as (room_id, name, creator, type, description, moderators).
+
+        One query; the server loads it once at startup into its RoomDirectory,
+        which keeps itself current from then on.
+        """
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT r.room_id, r.room_name, r.creator, r.room_type, r.description,
+                   GROUP_CONCAT(m.username, ?)
+            FROM rooms r
+            LEFT JOIN room_moderators m ON m.room_id = r.room_id
+            WHERE r.is_archived = 0
+            GROUP BY r.room_id
+            ORDER BY r.room_id
+            ''', (MODERATOR_SEPARATOR,))
+            return [(room_id, name, creator, room_type, description,
+                     moderators.split(MODERATOR_SEPARATOR) if moderators else [])
+                    for room_id, name, creator, room_type, description, moderators in cursor.fetchall()]
+
+    def _load_room_access(self):
+        # Caller holds self._access_lock, so updates made meanwhile wait and apply on top.
+        # Returns the rules; they are only kept if nothing invalidated them meanwhile
+        version = self._access_version
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT room_id, room_type, password FROM rooms')
+            access = {room_id: (room_type, password, set())
+                      for room_id, room_type, password in cursor.fetchall()}
+            cursor.execute('SELECT room_id, username FROM banned_users')
+            for room_id, username in cursor.fetchall():
+                if room_id in access:
+                    access[room_id][2].add(username)
+        if self._access_version == version:
+            self._room_access = access
+        return access
+
+    def invalidate_room_access(self):
+        """Reload rooms and bans on next use, e.g. after another server changed them."""
+        # No lock, so a broker event never waits behind a reload in progress
+        self._access_version += 1
+        self._room_access = None
+
     def verify_room_access(self, room_id, username, password=None):
-        with self._lock:
-            cursor = self.conn.cursor()
+        with self._access_lock:
+            access = self._room_access
+            if access is None:
+                access = self._load_room_access()
+            room = access.get(room_id)
             # Check if user is banned
-            cursor.execute('SELECT 1 FROM banned_users WHERE room_id = ? AND username = ?',
-                         (room_id, username))
-            if cursor.fetchone():
+            if room is not None and username in room[2]:
                 return False, "You are banned from this room"
-
-            # Get room info
-            cursor.execute('SELECT room_type, password FROM rooms WHERE room_id = ?', (room_id,))
-            room = cursor.fetchone()
-            if not room:
+            if room is None:
                 return False, "Room does not exist"
 
-            room_type, room_password = room
+            room_type, room_password, _ = room
             if room_type == 'public':
                 return True, None
             elif room_type == 'private' and room_password:
@@ -185,6 +482,23 @@ class Database:
                 return False, "Incorrect password"
             return False, "Access denied"
 
+    def verify_room_rejoin(self, room_id, username):
+        """Like verify_room_access for a room the session was already let into.
+
+        The password was checked on the original join; the room must still
+        exist and the user must not have been banned since.
+        """
+        with self._access_lock:
+            access = self._room_access
+            if access is None:
+                access = self._load_room_access()
+            room = access.get(room_id)
+            if room is None:
+                return False, "Room does not exist"
+            if username in room[2]:
+                return False, "You are banned from this room"
+            return True, None
+
     def add_room_moderator(self, room_id, username, added_by):
         with self._lock:
             cursor = self.conn.cursor()
@@ -203,6 +517,7 @@ class Database:
                 self.conn.commit()
                 return True, None
             except sqlite3.IntegrityError:
+                self.conn.rollback()
                 return False, "User is already a moderator"
 
     def ban_user(self, room_id, username, banned_by, reason=None):
@@ -223,8 +538,12 @@ class Database:
                 VALUES (?, ?, ?, ?)
                 ''', (room_id, username, banned_by, reason))
                 self.conn.commit()
+                with self._access_lock:
+                    if self._room_access is not None and room_id in self._room_access:
+                        self._room_access[room_id][2].add(username)
                 return True, None
             except sqlite3.IntegrityError:
+                self.conn.rollback()
                 return False, "User is already banned"
 
     def send_friend_request(self, from_user, to_user):
@@ -236,8 +555,10 @@ class Database:
                 VALUES (?, ?, 'pending')
                 ''', (from_user, to_user))
                 self.conn.commit()
+                self._update_cached_friends(from_user, to_user, 'pending')
                 return True, None
             except sqlite3.IntegrityError:
+                self.conn.rollback()
                 return False, "Friend request already exists"
 
     def accept_friend_request(self, from_user, to_user):
@@ -248,27 +569,64 @@ class Database:
             WHERE user1 = ? AND user2 = ? AND status = 'pending'
             ''', (from_user, to_user))
             self.conn.commit()
+            if cursor.rowcount > 0:
+                self._update_cached_friends(from_user, to_user, 'accepted')
             return cursor.rowcount > 0
 
     def get_friends(self, username):
-        with self._lock:
-            cursor = self.conn.cursor()
+        """[(friend, status)] for username, from memory once loaded."""
+        with self._friend_lock:
+            friends = self._friends.get(username)
+            if friends is not None:
+                self._friend_hits += 1
+                return list(friends.items())
+            self._friend_misses += 1
+            version = self._friend_version
+
+        with self.reader() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
             SELECT user2, status FROM friends WHERE user1 = ?
             UNION
             SELECT user1, status FROM friends WHERE user2 = ?
             ''', (username, username))
-            return cursor.fetchall()
+            friends = {}
+            for friend, status in cursor.fetchall():
+                # Requests in both directions: an accepted one wins
+                if friends.get(friend) != 'accepted':
+                    friends[friend] = status
+        with self._friend_lock:
+            if version == self._friend_version:
+                self._friends[username] = friends
+        return list(friends.items())
 
-    def get_room_moderators(self, room_id):
-        with self._lock:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT username FROM room_moderators WHERE room_id = ?', (room_id,))
-            return [row[0] for row in cursor.fetchall()]
+    def _update_cached_friends(self, user1, user2, status):
+        with self._friend_lock:
+            self._friend_version += 1
+            for username, friend in ((user1, user2), (user2, user1)):
+                friends = self._friends.get(username)
+                if friends is not None and friends.get(friend) != 'accepted':
+                    friends[friend] = status
+
+    def drop_friends(self, username):
+        """Forget a cached friend list: the user went offline, or another server changed it."""
+        with self._friend_lock:
+            self._friend_version += 1
+            self._friends.pop(username, None)
+
+    def friend_cache_stats(self):
+        with self._friend_lock:
+            lookups = self._friend_hits + self._friend_misses
+            return {
+                'size': len(self._friends),
+                'hits': self._friend_hits,
+                'misses': self._friend_misses,
+                'hit_rate': round(self._friend_hits / lookups, 4) if lookups else None
+            }
 
     def get_online_users(self):
-        with self._lock:
-            cursor = self.conn.cursor()
+        with self.reader() as conn:
+            cursor = conn.cursor()
             cursor.execute('SELECT username FROM users WHERE is_online = 1')
             return [user[0] for user in cursor.fetchall()]
 
@@ -279,13 +637,131 @@ class Database:
                 # Delete related records first
                 cursor.execute('DELETE FROM room_moderators WHERE room_id = ?', (room_id,))
                 cursor.execute('DELETE FROM banned_users WHERE room_id = ?', (room_id,))
+                cursor.execute('DELETE FROM messages WHERE room_id = ?', (room_id,))
                 # Finally delete the room
                 cursor.execute('DELETE FROM rooms WHERE room_id = ?', (room_id,))
                 self.conn.commit()
-            except Exception as e:
-                print(f"Error deleting room {room_id}: {e}")
+                with self._access_lock:
+                    if self._room_access is not None:
+                        self._room_access.pop(room_id, None)
+            except Exception:
+                log.exception("Error deleting room %s", room_id)
                 self.conn.rollback()
 
+    def allocate_ids(self, name, count):
+        """Reserve count consecutive ids from a named sequence; returns the first."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            try:
+                # First use: start after anything already stored. Each statement
+                # is atomic, so servers sharing the file never get the same block
+                cursor.execute('''
+                INSERT OR IGNORE INTO id_blocks (name, next_id)
+                SELECT ?, COALESCE(MAX(id), 0) + 1 FROM messages
+                ''', (name,))
+                cursor.execute('UPDATE id_blocks SET next_id = next_id + ? WHERE name = ? '
+                               'RETURNING next_id - ?', (count, name, count))
+                first = cursor.fetchall()[0][0]
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()  # don't leave the shared writer mid-transaction
+                raise
+            return first
+
+    def get_room_seqs(self):
+        """{room_id: highest stored seq}; MessageLog counts on from these."""
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT room_id, MAX(seq) FROM messages GROUP BY room_id')
+            return dict(cursor.fetchall())
+
+    def add_messages(self, messages):
+        """Insert (id, room_id, username, content, text_color, sent_at, seq) rows in one transaction."""
+        with self._lock:
+            try:
+                self.conn.executemany('''
+                INSERT OR IGNORE INTO messages (id, room_id, username, content, text_color, sent_at, seq)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', messages)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()  # a failed batch must not ride on the next commit
+                raise
+
+    def get_messages(self, room_id, before=None, limit=50):
+        """Newest first: up to limit messages in room_id with a seq below before."""
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            if before is None:
+                cursor.execute('''
+                SELECT id, room_id, username, content, text_color, sent_at, seq
+                FROM messages WHERE room_id = ?
+                ORDER BY seq DESC LIMIT ?
+                ''', (room_id, limit))
+            else:
+                cursor.execute('''
+                SELECT id, room_id, username, content, text_color, sent_at, seq
+                FROM messages WHERE room_id = ? AND seq < ?
+                ORDER BY seq DESC LIMIT ?
+                ''', (room_id, before, limit))
+            return cursor.fetchall()
+
+    def get_messages_after(self, room_id, after, limit=50):
+        """Oldest first: up to limit messages in room_id with a seq above after."""
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT id, room_id, username, content, text_color, sent_at, seq
+            FROM messages WHERE room_id = ? AND seq > ?
+            ORDER BY seq LIMIT ?
+            ''', (room_id, after, limit))
+            return cursor.fetchall()
+
+    def search_messages(self, query, room_id=None, include_public=True, offset=0, limit=20,
+                        timeout=SEARCH_TIMEOUT):
+        """Best matches first for an FTS5 query.
+
+        Searches room_id, plus every public room if include_public is set.
+        Returns (id, room_id, username, content, text_color, sent_at, seq) rows.
+        Ranking scores every match, so a query matching millions of rows is
+        slow; it is interrupted after timeout seconds with TimeoutError.
+        """
+        deadline = time.monotonic() + timeout
+        with self.reader() as conn:
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            try:
+                return self._search_messages(conn, query, room_id, include_public, offset, limit)
+            except sqlite3.OperationalError as e:
+                if 'interrupted' in str(e):
+                    raise TimeoutError(f"Search took longer than {timeout}s")
+                raise
+            finally:
+                conn.set_progress_handler(None, 0)
+
+    def _search_messages(self, conn, query, room_id, include_public, offset, limit):
+        cursor = conn.cursor()
+        if include_public:
+            cursor.execute('''
+            SELECT m.id, m.room_id, m.username, m.content, m.text_color, m.sent_at, m.seq
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+              AND (m.room_id = ? OR m.room_id IN (SELECT room_id FROM rooms WHERE room_type = 'public'))
+            ORDER BY messages_fts.rank, m.id DESC
+            LIMIT ? OFFSET ?
+            ''', (f'content : ({query})', room_id, limit, offset))
+        else:
+            # Let the index narrow to the room instead of filtering matches
+            cursor.execute('''
+            SELECT m.id, m.room_id, m.username, m.content, m.text_color, m.sent_at, m.seq
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+            ORDER BY messages_fts.rank, m.id DESC
+            LIMIT ? OFFSET ?
+            ''', (f'room_id : "{int(room_id)}" AND content : ({query})', limit, offset))
+        return cursor.fetchall()
+
     def update_user_profile(self, username, bio=None, pronouns=None, text_color=None):
         with self._lock:
             cursor = self.conn.cursor()
@@ -311,10 +787,22 @@ class Database:
                 '''
                 cursor.execute(query, params)
                 self.conn.commit()
+                # Write through; the version bump stops a read that started
+                # before this commit from caching the old row
+                self._update_cached_profile(username, bio=bio, pronouns=pronouns, text_color=text_color)
 
     def get_user_profile(self, username):
-        with self._lock:
-            cursor = self.conn.cursor()
+        with self._profile_lock:
+            profile = self._profiles.get(username)
+            if profile is not None:
+                self._profiles.move_to_end(username)
+                self._profile_hits += 1
+                return profile
+            self._profile_misses += 1
+            version = self._profile_version
+
+        with self.reader() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
             SELECT bio, pronouns, text_color
             FROM users
@@ -323,9 +811,61 @@ class Database:
             result = cursor.fetchone()
             if result:
                 bio, pronouns, text_color = result
-                return bio, pronouns, text_color
+                profile = (bio, pronouns, text_color)
+                self._cache_profile(username, profile, version)
+                return profile
             return None
 
+    def _cache_profile(self, username, profile, version):
+        with self._profile_lock:
+            if version != self._profile_version:
+                return  # a profile changed while we read; our row may be stale
+            self._profiles[username] = profile
+            self._profiles.move_to_end(username)
+            if len(self._profiles) > self._profile_cache_size:
+                self._profiles.popitem(last=False)
+
+    def _update_cached_profile(self, username, bio=None, pronouns=None, text_color=None):
+        with self._profile_lock:
+            self._profile_version += 1
+            cached = self._profiles.get(username)
+            if cached is None:
+                return
+            old_bio, old_pronouns, old_color = cached
+            self._profiles[username] = (
+                old_bio if bio is None else bio,
+                old_pronouns if pronouns is None else pronouns,
+                old_color if text_color is None else text_color
+            )
+
+    def invalidate_profile(self, username):
+        """Forget a cached profile, e.g. after another server changed it."""
+        with self._profile_lock:
+            self._profile_version += 1
+            self._profiles.pop(username, None)
+
+    def profile_cache_stats(self):
+        with self._profile_lock:
+            lookups = self._profile_hits + self._profile_misses
+            return {
+                'size': len(self._profiles),
+                'capacity': self._profile_cache_size,
+                'hits': self._profile_hits,
+                'misses': self._profile_misses,
+                'hit_rate': round(self._profile_hits / lookups, 4) if lookups else None
+            }
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
     def __del__(self):
-        if hasattr(self._local, 'conn') and self._local.conn:
-            self._local.conn.close() 
\ No newline at end of file
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,129 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from log import get_logger
+
+log = get_logger('db_executor')
+
+DB_WORKERS = 4
+DB_QUEUE_SIZE = 1000
+
+class DatabaseBusy(Exception):
+    """The executor's queue is full; the caller should report an error, not wait."""
+
+class DatabaseExecutor:
+    """Runs Database calls on dedicated threads and hands back futures.
+
+    Request handlers never wait on SQLite on their own thread (or on the
+    event loop): they submit the call and continue from the future. The
+    queue is bounded, so when the database falls behind, new requests fail
+    fast with DatabaseBusy rather than piling up without limit.
+
+    Writes whose in-memory effect has already happened can't just fail, so
+    defer() never refuses. Deferred jobs have a lane of their own: an
+    unbounded queue that one thread runs in order, so two writes to the
+    same row land in the order they were made.
+
+    Latency is tracked per query name: time spent waiting in the queue and
+    time spent running.
+    """
+
+    def __init__(self, db, workers=DB_WORKERS, max_queue=DB_QUEUE_SIZE):
+        self.db = db
+        self.max_queue = max_queue
+        self.rejected = 0
+        self._queue = queue.Queue(max_queue)
+        self._lane = queue.SimpleQueue()  # deferred jobs, run in order by one thread
+        self.deferred = 0
+        self._stats = {}  # {query name: [count, errors, wait total, run total, run max]}
+        self._stats_lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._worker, args=(self._queue,), daemon=True)
+                         for _ in range(workers)]
+        self._lane_thread = threading.Thread(target=self._worker, args=(self._lane,), daemon=True)
+        for thread in self._threads + [self._lane_thread]:
+            thread.start()
+
+    def _job(self, query, args):
+        func = getattr(self.db, query) if isinstance(query, str) else query
+        name = query if isinstance(query, str) else func.__name__
+        return Future(), name, func, args, time.perf_counter()
+
+    def submit(self, query, *args):
+        """Run a Database method (by name) or any callable; returns a Future."""
+        job = self._job(query, args)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self.rejected += 1
+            raise DatabaseBusy(f"Database queue is full ({self.max_queue} pending)")
+        return job[0]
+
+    def defer(self, query, *args):
+        """Like submit, but never raises DatabaseBusy; runs after every earlier defer()."""
+        job = self._job(query, args)
+        self.deferred += 1
+        self._lane.put(job)
+        return job[0]
+
+    def call(self, query, *args):
+        """Blocking convenience: submit and wait for the result."""
+        return self.submit(query, *args).result()
+
+    def _worker(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            future, name, func, args, queued_at = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                result = func(*args)
+            except BaseException as e:
+                self._record(name, started - queued_at, time.perf_counter() - started, True)
+                future.set_exception(e)
+            else:
+                self._record(name, started - queued_at, time.perf_counter() - started, False)
+                future.set_result(result)
+
+    def _record(self, name, waited, ran, failed):
+        with self._stats_lock:
+            entry = self._stats.get(name)
+            if entry is None:
+                entry = self._stats[name] = [0, 0, 0.0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += waited
+            entry[3] += ran
+            entry[4] = max(entry[4], ran)
+
+    def stats(self):
+        with self._stats_lock:
+            queries = {
+                name: {
+                    'count': count,
+                    'errors': errors,
+                    'avg_wait_ms': round(waited / count * 1000, 3),
+                    'avg_ms': round(ran / count * 1000, 3),
+                    'max_ms': round(ran_max * 1000, 3),
+                }
+                for name, (count, errors, waited, ran, ran_max) in self._stats.items()
+            }
+        return {
+            'workers': len(self._threads),
+            'pending': self._queue.qsize(),
+            'max_queue': self.max_queue,
+            'rejected': self.rejected,
+            'deferred': self.deferred,
+            'deferred_pending': self._lane.qsize(),
+            'queries': queries,
+        }
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        self._lane.put(None)
+        for thread in self._threads + [self._lane_thread]:
+            thread.join(1)
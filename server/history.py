@@ -0,0 +1,215 @@
+import time
+import threading
+from log import get_logger
+
+log = get_logger('history')
+
+MESSAGE_SEQUENCE = 'messages'
+ID_BLOCK_SIZE = 1000     # ids reserved per trip to the database
+WRITE_BATCH_SIZE = 2000  # most rows inserted per transaction
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE = 200
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE = 50
+MAX_SEARCH_TERMS = 8
+
+class MessageLog:
+    """Stores chat messages without making the sender wait for the disk.
+
+    append() gives the message an id and its room's next sequence number,
+    and queues the row. A background thread writes whatever has queued up
+    in one transaction, so under load one commit covers hundreds of
+    messages (group commit). Ids come from blocks reserved in the database,
+    so servers sharing a database never hand out the same id. The writer
+    reserves the next block before the current one runs out, so a sender
+    never waits behind a commit for one. Blocks interleave between servers,
+    so history is ordered and paged by seq, never by id.
+
+    Each room's last seq is kept in memory, loaded from the table at
+    startup. Servers in a cluster don't number messages themselves: they
+    take an id from new_message(), the broker hub assigns the seq, and the
+    sending server queues the row with add(). Every server follows the
+    numbering with observe(), so its counters are current if the hub
+    restarts and asks again.
+
+    Rows stay visible to page() while they wait for the writer, so history
+    never misses a message that was already broadcast.
+    """
+
+    def __init__(self, db, batch_size=WRITE_BATCH_SIZE, id_block=ID_BLOCK_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.id_block = id_block
+        self.next_id = 0
+        self.last_id = -1    # last id of the block in use
+        self.spare = None    # (first, last) of the next block, reserved by the writer
+        self.room_seqs = db.get_room_seqs()  # {room_id: last seq handed out or seen}
+        self.pending = []    # rows not yet handed to the writer
+        self.writing = []    # rows in the transaction being written
+        self.closed = False
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self._ready = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _reserve_block(self):
+        first = self.db.allocate_ids(MESSAGE_SEQUENCE, self.id_block)
+        return first, first + self.id_block - 1
+
+    def _allocate_id(self):
+        # Caller holds self._ready
+        if self.next_id > self.last_id:
+            if self.spare is None:
+                # The writer hasn't reserved one yet (only at startup or after
+                # a whole block went out during one commit): fetch it here
+                self.spare = self._reserve_block()
+            self.next_id, self.last_id = self.spare
+            self.spare = None  # the writer reserves the next one
+        message_id = self.next_id
+        self.next_id += 1
+        return message_id
+
+    def append(self, room_id, username, content, text_color):
+        """Queue a message for storage and return its (id, seq, sent_at)."""
+        sent_at = time.time()
+        with self._ready:
+            # Numbered in queue order
+            message_id = self._allocate_id()
+            seq = self.room_seqs.get(room_id, 0) + 1
+            self.room_seqs[room_id] = seq
+            self.pending.append((message_id, room_id, username, content, text_color, sent_at, seq))
+            self._ready.notify()
+        return message_id, seq, sent_at
+
+    def new_message(self, room_id):
+        """Return an id for a message someone else numbers, and the last seq seen in room_id."""
+        with self._ready:
+            return self._allocate_id(), self.room_seqs.get(room_id, 0)
+
+    def add(self, message_id, room_id, username, content, text_color, sent_at, seq):
+        """Queue a message that was numbered elsewhere (see new_message)."""
+        with self._ready:
+            self._observe(room_id, seq)
+            self.pending.append((message_id, room_id, username, content, text_color, sent_at, seq))
+            self._ready.notify()
+
+    def observe(self, room_id, seq):
+        """Note a seq handed out for a message stored by another server."""
+        with self._ready:
+            self._observe(room_id, seq)
+
+    def _observe(self, room_id, seq):
+        # Caller holds self._ready
+        if seq > self.room_seqs.get(room_id, 0):
+            self.room_seqs[room_id] = seq
+
+    def _write_loop(self):
+        while True:
+            with self._ready:
+                while not self.pending and self.spare is not None and not self.closed:
+                    self._ready.wait()
+                reserve = self.spare is None and not self.closed
+                if not self.pending and not reserve:
+                    return
+                # Everything that queued up during the last commit goes in this one
+                self.writing = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+                batch = self.writing
+            if reserve:
+                try:
+                    block = self._reserve_block()
+                except Exception:
+                    log.exception("Failed to reserve message ids")
+                    time.sleep(1)
+                else:
+                    with self._ready:
+                        if self.spare is None:
+                            self.spare = block
+            if not batch:
+                continue
+            try:
+                self.db.add_messages(batch)
+                self.written += len(batch)
+                self.batches += 1
+            except Exception:
+                self.failed += len(batch)
+                log.exception("Failed to store %d messages", len(batch))
+            with self._ready:
+                self.writing = []
+                self._ready.notify_all()
+
+    def page(self, room_id, before=None, limit=HISTORY_PAGE_SIZE):
+        """Newest first: up to limit messages in room_id with a seq below before."""
+        with self._ready:
+            # Snapshot the unwritten rows before reading the table; a row
+            # that commits in between just shows up twice and is deduplicated
+            unwritten = [row for row in self.writing + self.pending
+                         if row[1] == room_id and (before is None or row[6] < before)]
+        rows = {row[0]: row for row in self.db.get_messages(room_id, before, limit)}
+        for row in unwritten:
+            rows[row[0]] = row
+        return sorted(rows.values(), key=lambda row: row[6], reverse=True)[:limit]
+
+    def since(self, room_id, after, limit=HISTORY_PAGE_SIZE):
+        """Oldest first: up to limit messages in room_id with a seq above after."""
+        with self._ready:
+            unwritten = [row for row in self.writing + self.pending
+                         if row[1] == room_id and row[6] > after]
+        rows = {row[0]: row for row in self.db.get_messages_after(room_id, after, limit)}
+        for row in unwritten:
+            rows[row[0]] = row
+        return sorted(rows.values(), key=lambda row: row[6])[:limit]
+
+    def flush(self, timeout=None):
+        """Wait until every queued message is written."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._ready:
+            while self.pending or self.writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._ready.wait(remaining)
+        return True
+
+    def close(self, timeout=5):
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+        self._writer.join(timeout)
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'batches': self.batches,
+            'average_batch': round(self.written / self.batches, 1) if self.batches else 0,
+            'pending': len(self.pending) + len(self.writing),
+            'failed': self.failed,
+        }
+
+def message_to_dict(row):
+    message_id, room_id, username, content, text_color, sent_at, seq = row
+    return {
+        'id': message_id,
+        'seq': seq,
+        'room_id': room_id,
+        'username': username,
+        'content': content,
+        'text_color': text_color or '#000000',
+        'sent_at': sent_at
+    }
+
+def search_query(text):
+    """Turn what a user typed into a safe FTS5 query, or None if it has no words.
+
+    Every word must match (implicit AND). Each is quoted so FTS5 operators
+    in user input are taken literally; a trailing * keeps prefix matching.
+    """
+    terms = []
+    for word in text.split()[:MAX_SEARCH_TERMS]:
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' '.join(terms) or None
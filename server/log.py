@@ -0,0 +1,33 @@
+import sys
+import queue
+import logging
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+def get_logger(name):
+    """Loggers for the server modules all live under 'chat'."""
+    return logging.getLogger(f'chat.{name}')
+
+def setup_logging(level='INFO', payloads=False):
+    """Route 'chat' log records through a queue to a background writer thread.
+
+    Handlers only pay for a level check, plus formatting for records that
+    pass it; the write to stdout happens on the listener thread. Chat
+    message contents go to 'chat.payloads', which stays off unless
+    payloads is set. Returns the started QueueListener.
+    """
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, output)
+
+    root = logging.getLogger('chat')
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    root.propagate = False
+    get_logger('payloads').setLevel(logging.DEBUG if payloads else logging.CRITICAL + 1)
+
+    listener.start()
+    return listener
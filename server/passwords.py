@@ -0,0 +1,120 @@
+import os
+import hmac
+import secrets
+import base64
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from log import get_logger
+
+log = get_logger('passwords')
+
+# scrypt cost: about 16 MB and tens of milliseconds per hash. Stored with
+# each hash, so raising it later rehashes users as they log in
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_PREFIX = 'scrypt'
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+MAX_PENDING_HASHES = 256  # logins/registrations waiting for a worker before new ones are refused
+RESUME_TOKEN_TTL = 24 * 3600  # seconds a session can be resumed after its login
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * n)
+
+def hash_password(password):
+    """Return 'scrypt$n$r$p$salt$hash' for storing in users.password."""
+    salt = os.urandom(SALT_SIZE)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return '$'.join((HASH_PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+                     base64.b64encode(salt).decode('ascii'), base64.b64encode(digest).decode('ascii')))
+
+def is_hashed(stored):
+    return stored.startswith(HASH_PREFIX + '$')
+
+def check_password(password, stored):
+    """Return (matches, needs_rehash) for a password against a stored value.
+
+    Rows from before hashing hold the plaintext; they match the old way and
+    ask to be rehashed, as do hashes made with older cost settings.
+    """
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8')), True
+    _, n, r, p, salt, digest = stored.split('$')
+    n, r, p = int(n), int(r), int(p)
+    actual = _scrypt(password, base64.b64decode(salt), n, r, p)
+    matches = hmac.compare_digest(actual, base64.b64decode(digest))
+    return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+def new_resume_token():
+    """Return (token, digest): the token goes to the client, only the digest is stored."""
+    token = secrets.token_urlsafe(32)
+    return token, token_digest(token)
+
+def token_digest(token):
+    # Tokens are random, so a fast hash is enough to make a leaked table useless
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+class HasherBusy(Exception):
+    """Too many hashes are waiting; the caller should report an error, not wait."""
+
+class PasswordHasher:
+    """Runs password hashing in a pool of worker processes.
+
+    A hash takes tens of milliseconds of CPU. On a handler thread or the
+    event loop that would hold up chat traffic, and threads would contend
+    for the GIL around it, so the work goes to separate processes. At most
+    max_pending hashes may be queued or running; past that hash() and
+    verify() raise HasherBusy at once, so a login storm can't build an
+    unbounded backlog.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=MAX_PENDING_HASHES):
+        # spawn: the server is multithreaded, and forking a threaded process is unsafe
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def _submit(self, func, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusy(f"{self.pending} password hashes pending")
+            self.pending += 1
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def hash(self, password):
+        """Future for hash_password(password)."""
+        return self._submit(hash_password, password)
+
+    def verify(self, password, stored):
+        """Future for check_password(password, stored)."""
+        return self._submit(check_password, password, stored)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def close(self):
+        # Waits for hashes already running (a few tens of ms), so no worker outlives the server
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,88 @@
+import time
+import threading
+from datetime import datetime
+from log import get_logger
+
+log = get_logger('presence')
+
+PRESENCE_FLUSH_INTERVAL = 0.5  # seconds a status change may wait before it is written
+PRESENCE_BATCH_SIZE = 500      # changes that trigger a write straight away
+
+class PresenceWriter:
+    """Persists users' online status in batches.
+
+    The server's own session maps are the source of truth for who is
+    online; the is_online column is only a record of it. set() just notes
+    the latest status per user. A background thread writes everything
+    noted since the last write in one transaction, every flush interval or
+    as soon as a batch fills up, so a wave of reconnects costs a handful of
+    commits instead of one per login. Repeated changes for one user
+    collapse to the last one.
+
+    A crash can lose the last interval's changes, leaving is_online stale.
+    The server resets the column at startup, so it is never wrong after a
+    restart.
+    """
+
+    def __init__(self, db, interval=PRESENCE_FLUSH_INTERVAL, batch_size=PRESENCE_BATCH_SIZE):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = {}  # {username: (is_online, changed_at)}
+        self.closed = False
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self._ready = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def set(self, username, is_online):
+        with self._ready:
+            self.pending[username] = (is_online, datetime.now())
+            if len(self.pending) >= self.batch_size:
+                self._ready.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._ready:
+                deadline = time.monotonic() + self.interval
+                while len(self.pending) < self.batch_size and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                batch, self.pending = self.pending, {}
+                closed = self.closed
+            if batch:
+                self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch):
+        try:
+            self.db.set_user_statuses([(is_online, changed_at, username)
+                                       for username, (is_online, changed_at) in batch.items()])
+            self.written += len(batch)
+            self.batches += 1
+        except Exception:
+            log.exception("Failed to store %d status changes", len(batch))
+            with self._ready:
+                # Retry next time, unless the user's status has changed since
+                for username, change in batch.items():
+                    self.pending.setdefault(username, change)
+            self.failed += len(batch)
+
+    def close(self, timeout=5):
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+        self._writer.join(timeout)
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'batches': self.batches,
+            'pending': len(self.pending),
+            'failed': self.failed,
+        }
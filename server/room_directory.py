@@ -0,0 +1,101 @@
+import threading
+
+class RoomDirectory:
+    """Versioned in-memory copy of the room list that clients display.
+
+    Clients get a full snapshot ('room_state') once, then small delta
+    messages. Every delta carries the next sequence number, so a client
+    that sees a gap knows it missed something and asks for a new snapshot.
+
+    Mutations only record which rooms changed; drain() turns the pending
+    changes into delta messages. Several changes to the same room between
+    two drains collapse into one delta.
+    """
+
+    def __init__(self, lock=None):
+        self.rooms = {}  # {room_id: room dict as sent to clients}
+        self.seq = 0
+        # Pass the server's index lock so membership changes (which update
+        # user counts) and delta broadcasts (which read membership) can't
+        # take the two locks in opposite orders
+        self.lock = lock or threading.RLock()
+        self._pending = {}  # {(room_id, 'room' | 'user_count' | 'moderators'): None}, in change order
+
+    def load(self, rooms):
+        with self.lock:
+            self.rooms = {room['id']: room for room in rooms}
+            self._pending.clear()
+
+    def add_room(self, room):
+        with self.lock:
+            self.rooms[room['id']] = room
+            self._mark(room['id'], 'room')
+
+    def remove_room(self, room_id):
+        with self.lock:
+            if self.rooms.pop(room_id, None) is None:
+                return
+            for kind in ('user_count', 'moderators'):
+                self._pending.pop((room_id, kind), None)
+            self._mark(room_id, 'room')
+
+    def set_user_count(self, room_id, user_count):
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room is None or room['user_count'] == user_count:
+                return
+            room['user_count'] = user_count
+            self._mark(room_id, 'user_count')
+
+    def set_moderators(self, room_id, moderators):
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room is None or room['moderators'] == moderators:
+                return
+            room['moderators'] = list(moderators)
+            self._mark(room_id, 'moderators')
+
+    def get(self, room_id):
+        return self.rooms.get(room_id)
+
+    def _mark(self, room_id, kind):
+        self._pending[(room_id, kind)] = None
+
+    def has_changes(self):
+        return bool(self._pending)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'type': 'room_state',
+                'seq': self.seq,
+                'rooms': [dict(room) for room in self.rooms.values()]
+            }
+
+    def drain(self):
+        """Turn pending changes into delta messages, each with its own seq."""
+        with self.lock:
+            deltas = []
+            added = set()
+            for room_id, kind in self._pending:
+                room = self.rooms.get(room_id)
+                if kind == 'room':
+                    if room is None:
+                        delta = {'type': 'room_removed', 'room_id': room_id}
+                    else:
+                        # A full room already carries its latest count and moderators
+                        added.add(room_id)
+                        delta = {'type': 'room_added', 'room': dict(room)}
+                elif room is None or room_id in added:
+                    continue
+                elif kind == 'user_count':
+                    delta = {'type': 'user_count_changed', 'room_id': room_id,
+                             'user_count': room['user_count']}
+                else:
+                    delta = {'type': 'moderators_changed', 'room_id': room_id,
+                             'moderators': list(room['moderators'])}
+                self.seq += 1
+                delta['seq'] = self.seq
+                deltas.append(delta)
+            self._pending.clear()
+            return deltas
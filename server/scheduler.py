@@ -0,0 +1,79 @@
+import threading
+import asyncio
+from log import get_logger
+
+log = get_logger('scheduler')
+
+class BroadcastScheduler:
+    """Coalesces state broadcasts (presence, room directory) into ticks.
+
+    Handlers call mark_dirty() instead of broadcasting directly. The first
+    mark starts a timer; when it fires every dirty channel is flushed once,
+    however many events happened in between. During a login storm this
+    turns N logins x N clients messages into one broadcast per tick.
+
+    A tick of 0 flushes immediately, i.e. no coalescing.
+    """
+
+    def __init__(self, tick=0.1):
+        self.tick = tick
+        self.flushers = {}  # {channel: callback}, flushed in registration order
+        self.dirty = set()
+        self.scheduled = False
+        self.flushes = 0
+        self.marks = 0
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def register(self, channel, callback):
+        self.flushers[channel] = callback
+
+    def use_event_loop(self, loop):
+        # In asyncio mode flushes run on the loop instead of timer threads
+        self.loop = loop
+
+    def mark_dirty(self, channel):
+        if self.tick <= 0:
+            self.marks += 1
+            self._run(channel)
+            return
+        with self._lock:
+            self.marks += 1
+            self.dirty.add(channel)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self._call_later(self.tick, self.flush)
+
+    def flush(self):
+        with self._lock:
+            dirty, self.dirty = self.dirty, set()
+            self.scheduled = False
+            self.flushes += 1
+        for channel in self.flushers:
+            if channel in dirty:
+                self._run(channel)
+
+    def _run(self, channel):
+        try:
+            self.flushers[channel]()
+        except Exception:
+            log.exception("Error flushing %s broadcast", channel)
+
+    def _call_later(self, delay, callback):
+        if self.loop is None:
+            timer = threading.Timer(delay, callback)
+            timer.daemon = True
+            timer.start()
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.loop.call_later(delay, callback)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+
+    def stats(self):
+        return {'tick': self.tick, 'marks': self.marks, 'flushes': self.flushes}
@@ -1,522 +1,1423 @@
 import socket
 import threading
 import json
+import asyncio
+import argparse
+import os
+import sys
+import signal
+import tempfile
+import time
+import secrets
+
+# The wire protocol lives in common/, shared with the client
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import negotiate, hello_reply, read_message_async, FrameReader, ProtocolError
 from database import Database
+from db_executor import DatabaseExecutor, DatabaseBusy
+from presence import PresenceWriter
+from passwords import (PasswordHasher, HasherBusy, hash_password, is_hashed, new_resume_token,
+                       token_digest, RESUME_TOKEN_TTL)
+from connection import ThreadedConnection, AsyncConnection, QUEUE_POLICIES, DROP_OLDEST
+from room_directory import RoomDirectory
+from scheduler import BroadcastScheduler
+from broker import BrokerHub, BrokerClient, SECRET_ENV
+from log import get_logger, setup_logging, LOG_LEVELS
+from history import (MessageLog, message_to_dict, search_query, HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE,
+                     SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE)
 import pickle
+import logging
+
+log = get_logger('server')
+payload_log = get_logger('payloads')
 
 class ChatServer:
-    def __init__(self, host='10.0.0.38', port=5000):
+    def __init__(self, host='10.0.0.38', port=5000, queue_size=1000, queue_policy=DROP_OLDEST,
+                 broadcast_tick=0.1, reuse_port=False, broker=None):
         self.host = host
         self.port = port
+        self.queue_size = queue_size      # max frames buffered per connection
+        self.queue_policy = queue_policy  # what to do when a connection's queue is full
+        self.slow_consumers = 0           # connections dropped by the disconnect policy
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            # Worker processes all bind the same port; the kernel spreads connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
         
         self.db = Database()
-        self.clients = {}  # {client_socket: username}
+        self.history = MessageLog(self.db)  # stores chat messages in the background
+        self.db_executor = DatabaseExecutor(self.db)  # handlers' queries run here, off the event loop
+        self.presence = PresenceWriter(self.db)  # is_online writes, batched
+        self.passwords = PasswordHasher()  # password hashing, in worker processes
+        self.clients = {}  # {connection: username}
         self.rooms = {}    # {room_id: set(usernames)}
+
+        # Reverse indexes so fanout and user lookups never scan self.clients
+        self.user_connections = {}  # {username: set(connections)}, one per session
+        self.room_connections = {}  # {room_id: set(connections)}
+        self.connection_rooms = {}  # {connection: room_id}
+        self.index_lock = threading.RLock()
+
+        # Other server processes sharing this chat, as seen through the broker
+        self.broker = broker
+        self.loop = None                # set in asyncio mode; broker events run on it
+        self.log_listener = None        # stopped before os._exit so queued log records get written
+        self.local_room_counts = {}     # {room_id: users here}, last value published
+        self.count_changes = {}         # {room_id: users here} not yet published
+        self.count_lock = threading.Lock()  # keeps room_count events in order
+        self.remote_users = {}          # {node: set(usernames)}
+        self.remote_room_counts = {}    # {node: {room_id: user_count}}
         
         # Initialize rooms from database
-        db_rooms = self.db.get_rooms(include_private=True)
-        for room in db_rooms:
-            room_id = room[0]  # First element is room_id
+        self.directory = RoomDirectory(self.index_lock)
+        directory_rooms = []
+        for room in self.db.get_room_directory():  # one query, moderators included
+            room_id, room_name, creator, room_type, description, moderators = room
             self.rooms[room_id] = set()  # Initialize with empty set of users
+            directory_rooms.append(self.make_room_info(
+                room_id, room_name, creator, room_type, description, moderators
+            ))
+        self.directory.load(directory_rooms)
+
+        # Presence and room changes are flushed at most once per tick;
+        # chat messages never go through the scheduler
+        self.scheduler = BroadcastScheduler(broadcast_tick)
+        self.scheduler.register('presence', self.broadcast_online_users)
+        self.scheduler.register('rooms', self.publish_room_changes)
         
-        print(f"Server running on {host}:{port}")
-        print(f"Loaded {len(self.rooms)} rooms from database")
+        log.info("Server running on %s:%s", host, port)
+        log.info("Loaded %d rooms from database", len(self.rooms))
+
+    def add_session(self, client, username):
+        with self.index_lock:
+            if client in self.clients:
+                self._drop_session(client)
+            self.clients[client] = username
+            self.user_connections.setdefault(username, set()).add(client)
+        self.publish_room_counts()
+
+    def remove_session(self, client):
+        """Drop a logged-in connection from every index. Returns its username."""
+        with self.index_lock:
+            username = self._drop_session(client)
+        self.publish_room_counts()
+        return username
+
+    def _drop_session(self, client):
+        # Caller holds index_lock
+        username = self.clients.get(client)
+        if username is None:
+            return None
+        self.leave_room(client)
+        del self.clients[client]
+        sessions = self.user_connections.get(username)
+        if sessions is not None:
+            sessions.discard(client)
+            if not sessions:
+                del self.user_connections[username]
+        return username
+
+    def move_to_room(self, client, room_id):
+        with self.index_lock:
+            self.leave_room(client)
+            self.connection_rooms[client] = room_id
+            self.room_connections.setdefault(room_id, set()).add(client)
+            self.rooms.setdefault(room_id, set()).add(self.clients[client])
+            self.update_user_count(room_id)
+        self.publish_room_counts()
+        if client.session_token is not None:
+            # A resumed session comes back to this room
+            self.db_submit('set_session_room', client.session_token, room_id)
+
+    def leave_room(self, client):
+        """Take a connection out of its current room. Returns the room_id it left."""
+        with self.index_lock:
+            room_id = self.connection_rooms.pop(client, None)
+            if room_id is None:
+                return None
+            members = self.room_connections.get(room_id)
+            if members is not None:
+                members.discard(client)
+                if not members:
+                    del self.room_connections[room_id]
+            # The user stays in the room while another of their sessions is there
+            username = self.clients.get(client)
+            if username is not None and room_id in self.rooms:
+                if not any(self.connection_rooms.get(other) == room_id
+                           for other in self.user_connections.get(username, ())):
+                    self.rooms[room_id].discard(username)
+                    self.update_user_count(room_id)
+            return room_id
+
+    def remove_user_from_room(self, username, room_id):
+        with self.index_lock:
+            for client in self.connections_in_room(room_id):
+                if self.clients.get(client) == username:
+                    self.leave_room(client)
+            if room_id in self.rooms:
+                self.rooms[room_id].discard(username)
+                self.update_user_count(room_id)
+        self.publish_room_counts()
+
+    def connections_for(self, username):
+        with self.index_lock:
+            return tuple(self.user_connections.get(username, ()))
+
+    def connections_in_room(self, room_id):
+        with self.index_lock:
+            return tuple(self.room_connections.get(room_id, ()))
+
+    def is_online(self, username):
+        # Sessions on this node only
+        return username in self.user_connections
 
-    def broadcast_room_state(self):
+    def is_online_anywhere(self, username):
+        with self.index_lock:
+            if username in self.user_connections:
+                return True
+            return any(username in users for users in self.remote_users.values())
+
+    def online_users(self):
+        with self.index_lock:
+            users = set(self.user_connections)
+            for node_users in self.remote_users.values():
+                users.update(node_users)
+            return sorted(users)
+
+    def send_to_user(self, username, message_dict):
+        # Delivers to every session the user has open
+        for client in self.connections_for(username):
+            self.send_to_client(client, message_dict)
+
+    def notify_user(self, username, message_dict):
+        # Like send_to_user, but also reaches sessions on other nodes
+        self.send_to_user(username, message_dict)
+        self.publish('user_message', username=username, message=message_dict)
+
+    @staticmethod
+    def make_room_info(room_id, room_name, creator, room_type, description, moderators, user_count=0):
+        return {
+            'id': room_id,
+            'name': room_name,
+            'creator': creator,
+            'type': room_type,
+            'description': description,
+            'moderators': moderators,
+            'user_count': user_count
+        }
+
+    def update_user_count(self, room_id):
+        # Called with index_lock held after local membership changes. The
+        # other processes hear of it from publish_room_counts, once the
+        # lock is released
+        local_count = len(self.rooms.get(room_id, ()))
+        if self.local_room_counts.get(room_id, 0) != local_count:
+            if local_count:
+                self.local_room_counts[room_id] = local_count
+            else:
+                self.local_room_counts.pop(room_id, None)
+            self.count_changes[room_id] = local_count
+        self.refresh_user_count(room_id)
+
+    def publish_room_counts(self):
+        """Publish the room counts changed so far. Never called with index_lock held."""
+        with self.count_lock:
+            with self.index_lock:
+                changes, self.count_changes = self.count_changes, {}
+            for room_id, count in changes.items():
+                self.publish('room_count', room_id=room_id, count=count)
+
+    def refresh_user_count(self, room_id):
+        total = len(self.rooms.get(room_id, ()))
+        for counts in self.remote_room_counts.values():
+            total += counts.get(room_id, 0)
+        self.directory.set_user_count(room_id, total)
+
+    def publish(self, kind, **fields):
+        if self.broker is not None:
+            self.broker.publish(kind, **fields)
+
+    def start_broker(self):
+        if self.broker is None:
+            return
+        self.broker.start(self.on_broker_event)
+        # Ask the processes already running for their users and room counts
+        self.publish('sync_request')
+
+    def on_broker_event(self, event):
+        # Called on the broker's thread; in asyncio mode hop onto the loop
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.handle_broker_event, event)
+        else:
+            self.handle_broker_event(event)
+
+    def handle_broker_event(self, event):
+        # Takes index_lock only around index changes: publishing happens
+        # after it is released, and so do removals that publish room counts.
+        # Database caches are invalidated outside it too
+        kind = event['kind']
+        node = event['node']
         try:
-            # Get room names from database
-            db_rooms = self.db.get_rooms(include_private=True)
-            print(f"Broadcasting rooms: Found {len(db_rooms)} rooms in database")
-            room_info = []  # Change to list instead of dict
-            for room in db_rooms:
-                room_id, room_name, creator, room_type, description = room
-                # Make sure room exists in self.rooms
-                if room_id not in self.rooms:
-                    self.rooms[room_id] = set()
-                moderators = self.db.get_room_moderators(room_id)
-                room_data = {
-                    'id': room_id,
-                    'name': room_name,
-                    'creator': creator,
-                    'type': room_type,
-                    'description': description,
-                    'moderators': moderators,
-                    'user_count': len(self.rooms.get(room_id, set()))
-                }
-                room_info.append(room_data)
-            
-            room_state = {
-                'type': 'room_state',
-                'rooms': room_info
-            }
-            print(f"Broadcasting room state: {json.dumps(room_state)}")
-            self.broadcast_message(room_state)  # Send as dict, not JSON string
-        except Exception as e:
-            print(f"Error broadcasting room state: {e}")
+            if kind == 'room_message':
+                # Numbered by the broker; the node it came from stores it
+                message = event['message']
+                if node == self.broker.node_id:
+                    self.history.add(message['id'], event['room_id'], message['username'],
+                                     message['content'], message['text_color'],
+                                     message['sent_at'], message['seq'])
+                else:
+                    self.history.observe(event['room_id'], message['seq'])
+                self.broadcast_message(message, event['room_id'])
+
+            elif kind == 'user_message':
+                self.send_to_user(event['username'], event['message'])
+
+            elif kind == 'profile_changed':
+                self.db.invalidate_profile(event['username'])
+
+            elif kind == 'friends_changed':
+                for username in event['usernames']:
+                    self.db.drop_friends(username)
+
+            elif kind == 'kick':
+                self.db.invalidate_room_access()
+                self.remove_user_from_room(event['username'], event['room_id'])
+                self.scheduler.mark_dirty('rooms')
+
+            elif kind in ('user_online', 'user_offline'):
+                with self.index_lock:
+                    users = self.remote_users.setdefault(node, set())
+                    if kind == 'user_online':
+                        users.add(event['username'])
+                    else:
+                        users.discard(event['username'])
+                self.scheduler.mark_dirty('presence')
+
+            elif kind == 'room_count':
+                with self.index_lock:
+                    counts = self.remote_room_counts.setdefault(node, {})
+                    counts[event['room_id']] = event['count']
+                    self.refresh_user_count(event['room_id'])
+                self.scheduler.mark_dirty('rooms')
+
+            elif kind == 'room_added':
+                self.db.invalidate_room_access()
+                with self.index_lock:
+                    room = event['room']
+                    self.rooms.setdefault(room['id'], set())
+                    self.directory.add_room(room)
+                    self.refresh_user_count(room['id'])
+                self.scheduler.mark_dirty('rooms')
+
+            elif kind == 'room_removed':
+                self.db.invalidate_room_access()
+                with self.index_lock:
+                    self.rooms.pop(event['room_id'], None)
+                    self.directory.remove_room(event['room_id'])
+                self.scheduler.mark_dirty('rooms')
+
+            elif kind == 'moderators_changed':
+                with self.index_lock:
+                    self.directory.set_moderators(event['room_id'], event['moderators'])
+                self.scheduler.mark_dirty('rooms')
+
+            elif kind == 'reconnected':
+                # Our broker link dropped and came back. The others were told
+                # this node went down, and node_down events for nodes that
+                # died meanwhile were missed: start over on both sides
+                with self.index_lock:
+                    stale_rooms = set()
+                    for counts in self.remote_room_counts.values():
+                        stale_rooms.update(counts)
+                    self.remote_users.clear()
+                    self.remote_room_counts.clear()
+                    for room_id in stale_rooms:
+                        self.refresh_user_count(room_id)
+                self.db.invalidate_room_access()
+                self.publish_node_state()
+                self.publish('sync_request')
+                self.scheduler.mark_dirty('presence')
+                self.scheduler.mark_dirty('rooms')
+
+            elif kind == 'sync_request':
+                self.publish_node_state()
+
+            elif kind in ('node_state', 'node_down'):
+                # Replace (or forget) everything we knew about that process
+                with self.index_lock:
+                    old_counts = self.remote_room_counts.pop(node, {})
+                    self.remote_users.pop(node, None)
+                    if kind == 'node_state':
+                        self.remote_users[node] = set(event['users'])
+                        self.remote_room_counts[node] = {room_id: count for room_id, count in event['room_counts']}
+                    for room_id in set(old_counts) | set(self.remote_room_counts.get(node, {})):
+                        self.refresh_user_count(room_id)
+                self.scheduler.mark_dirty('presence')
+                self.scheduler.mark_dirty('rooms')
+        except Exception:
+            log.exception("Error handling broker event %s", kind)
+
+    def publish_node_state(self):
+        with self.index_lock:
+            users = list(self.user_connections)
+            room_counts = list(self.local_room_counts.items())
+        self.publish('node_state', users=users, room_counts=room_counts)
+
+    def send_room_state(self, client_socket):
+        # Snapshot and deltas go out under the same lock, so a client never
+        # gets a delta older than its snapshot ahead of it
+        with self.directory.lock:
+            self.send_to_client(client_socket, self.directory.snapshot(), key='room_state')
+
+    def publish_room_changes(self):
+        """Broadcast whatever changed in the room directory as seq-numbered deltas."""
+        try:
+            with self.directory.lock:
+                for delta in self.directory.drain():
+                    self.broadcast_message(delta)
+        except Exception:
+            log.exception("Error broadcasting room changes")
 
     def broadcast_online_users(self):
         online_users = {
             'type': 'online_users',
-            'users': list(self.clients.values())
+            'users': self.online_users()
         }
         # Send as dict, not JSON string
-        self.broadcast_message(online_users)
+        self.broadcast_message(online_users, key='online_users')
 
-    def send_to_client(self, client_socket, message_dict):
+    def send_to_client(self, client_socket, message_dict, key=None):
+        # Only queues the frame; the connection's writer does the socket I/O,
+        # so a slow client never blocks the calling handler.
+        # key marks snapshot messages that the coalesce policy may replace.
         try:
-            # Convert message to JSON string
-            json_str = json.dumps(message_dict)
-            message_bytes = json_str.encode()
-            
-            # First send the message length
-            message_length = len(message_bytes)
-            length_header = str(message_length).zfill(10).encode()  # Fixed 10-byte length header
-            client_socket.send(length_header)
-            
-            # Then send the actual message in chunks
-            chunk_size = 8192
-            for i in range(0, len(message_bytes), chunk_size):
-                chunk = message_bytes[i:i + chunk_size]
-                client_socket.send(chunk)
-                
-            return True
+            return client_socket.send(client_socket.codec.encode(message_dict), key)
         except Exception as e:
-            print(f"Error sending message to client: {e}")
+            log.error("Error sending message to client: %s", e)
             return False
 
-    def broadcast_message(self, message, room_id=None):
+    def broadcast_message(self, message, room_id=None, key=None):
         if room_id:
             # Send to specific room
-            room_clients = [client for client, username in self.clients.items()
-                          if username in self.rooms.get(room_id, set())]
-            for client in room_clients:
-                try:
-                    self.send_to_client(client, message)
-                except:
-                    self.remove_client(client)
+            recipients = self.connections_in_room(room_id)
         else:
             # Send to all clients
-            for client in list(self.clients.keys()):
+            with self.index_lock:
+                recipients = tuple(self.clients)
+        if not recipients:
+            return
+        # Serialize once per protocol codec in use; every recipient with
+        # that codec queues the same bytes object
+        frames = {}
+        for client in recipients:
+            frame = frames.get(client.codec)
+            if frame is None:
                 try:
-                    self.send_to_client(client, message)
-                except:
-                    self.remove_client(client)
+                    frame = frames[client.codec] = client.codec.encode(message)
+                except Exception as e:
+                    log.error("Error encoding broadcast: %s", e)
+                    return
+            client.send(frame, key)
+
+    def get_queue_stats(self):
+        connections = [(username, client.stats()) for client, username in list(self.clients.items())]
+        deepest = sorted(connections, key=lambda item: item[1]['depth'], reverse=True)[:10]
+        return {
+            'policy': self.queue_policy,
+            'max_queue': self.queue_size,
+            'connections': len(connections),
+            'total_depth': sum(stats['depth'] for _, stats in connections),
+            'max_depth': max((stats['max_depth'] for _, stats in connections), default=0),
+            'dropped': sum(stats['dropped'] for _, stats in connections),
+            'coalesced': sum(stats['coalesced'] for _, stats in connections),
+            'slow_consumers_disconnected': self.slow_consumers,
+            'deepest': [{'username': username, **stats} for username, stats in deepest],
+        }
 
     def handle_client(self, client_socket, addr):
+        connection = ThreadedConnection(client_socket, addr, self.queue_size, self.queue_policy)
+        frames = FrameReader()
         while True:
             try:
-                # First receive the message length
-                length_header = client_socket.recv(10)
-                if not length_header:
-                    print(f"Client {addr} disconnected")
-                    break
-                
-                message_length = int(length_header.decode().strip())
-                
-                # Initialize buffer for receiving data
-                data_buffer = bytearray()
-                bytes_received = 0
-                
-                # Receive the full message
-                while bytes_received < message_length:
-                    chunk_size = min(8192, message_length - bytes_received)
-                    chunk = client_socket.recv(chunk_size)
-                    if not chunk:
-                        raise ConnectionError("Connection closed while receiving message")
-                    data_buffer.extend(chunk)
-                    bytes_received += len(chunk)
-                
-                # Decode and parse the complete message
-                message = data_buffer.decode()
-                data = json.loads(message)
-                
-                # Log the received data for debugging
-                print(f"Received message type: {data.get('type')}")
-                if data.get('type') == 'update_profile':
-                    print(f"Profile update received for user: {self.clients.get(client_socket)}")
-                    if 'profile_pic' in data:
-                        pic_length = len(data['profile_pic']) if data['profile_pic'] else 0
-                        print(f"Profile picture data length: {pic_length}")
-                
-                # Handle different message types
-                if data['type'] == 'login':
-                    if self.db.verify_user(data['username'], data['password']):
-                        self.clients[client_socket] = data['username']
-                        self.db.update_user_status(data['username'], True)
-                        self.send_to_client(client_socket, {
-                            'type': 'login_response',
-                            'success': True,
-                            'username': data['username']
-                        })
-                        self.broadcast_online_users()
-                        self.broadcast_room_state()  # Broadcast rooms after successful login
-                        print(f"User {data['username']} logged in, broadcasting room state")
-                    else:
-                        self.send_to_client(client_socket, {
-                            'type': 'login_response',
-                            'success': False
-                        })
+                # The codec can change after a hello, so look it up per frame
+                data = frames.read_message(client_socket, connection.codec)
+                self.handle_message(connection, data)
+
+            except ConnectionError:
+                log.info("Client %s disconnected", addr)
+                break
+            except ProtocolError as e:
+                # The stream can't be trusted past a bad header
+                log.warning("Protocol error from %s: %s", addr, e)
+                break
+            except json.JSONDecodeError as e:
+                log.warning("JSON decode error from %s: %s", addr, e)
+                continue
+            except Exception:
+                log.exception("Error handling client %s", addr)
+                break
+
+        self.remove_client(connection)
+
+    async def handle_client_async(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        log.info("New connection from %s", addr)
+        connection = AsyncConnection(writer, addr, self.queue_size, self.queue_policy)
+        while True:
+            try:
+                data = await read_message_async(reader, connection.codec)
+                pending = self.handle_message(connection, data)
+                if pending is not None:
+                    # Finish this request before reading the next one, so a
+                    # connection's messages are still handled in order
+                    await pending
+
+            except (asyncio.IncompleteReadError, ConnectionError):
+                log.info("Client %s disconnected", addr)
+                break
+            except ProtocolError as e:
+                # The stream can't be trusted past a bad header
+                log.warning("Protocol error from %s: %s", addr, e)
+                break
+            except json.JSONDecodeError as e:
+                log.warning("JSON decode error from %s: %s", addr, e)
+                continue
+            except Exception:
+                log.exception("Error handling client %s", addr)
+                break
+
+        self.remove_client(connection)
+
+    def db_request(self, client_socket, query, *args, then, on_error=None):
+        """Run a database query on the executor, then continue with then(result).
+
+        In threaded mode this waits on the connection's own thread and returns
+        None. In asyncio mode it returns a future straight away; then() runs on
+        the event loop once the query is done, and the future completes after
+        it. Errors go to on_error(exception) if given, otherwise the client
+        gets a generic error. A full queue is reported to the client at once.
+        """
+        try:
+            future = self.db_executor.submit(query, *args)
+        except DatabaseBusy:
+            log.warning("Database busy, rejected %s from %s", query, client_socket.addr)
+            self.send_busy(client_socket)
+            return None
+        return self.continue_with(client_socket, query, future, then, on_error)
+
+    def hash_request(self, client_socket, method, *args, then, on_error=None):
+        """Like db_request, for PasswordHasher.hash or .verify."""
+        try:
+            future = getattr(self.passwords, method)(*args)
+        except HasherBusy:
+            log.warning("Password hashing busy, rejected %s from %s", method, client_socket.addr)
+            self.send_busy(client_socket)
+            return None
+        return self.continue_with(client_socket, method, future, then, on_error)
+
+    def send_busy(self, client_socket):
+        self.send_to_client(client_socket, {
+            'type': 'error',
+            'message': 'Server is busy, please try again'
+        })
+
+    def continue_with(self, client_socket, query, future, then, on_error):
+        """Call then(result) once future is done; see db_request."""
+        if self.loop is None:
+            return self._finish_request(client_socket, query, future, then, on_error)
+        done = self.loop.create_future()
+        future.add_done_callback(lambda _: self.loop.call_soon_threadsafe(
+            self._resume_request, client_socket, query, future, then, on_error, done))
+        return done
+
+    def _finish_request(self, client_socket, query, future, then, on_error):
+        try:
+            result = future.result()
+        except Exception as e:
+            if on_error is not None:
+                return on_error(e)
+            log.exception("Database error in %s", query)
+            self.send_to_client(client_socket, {
+                'type': 'error',
+                'message': 'Request failed'
+            })
+            return None
+        return then(result)
+
+    def _resume_request(self, client_socket, query, future, then, on_error, done):
+        # Runs on the event loop; then() may start another request, which
+        # done waits for too
+        try:
+            pending = self._finish_request(client_socket, query, future, then, on_error)
+        except Exception:
+            log.exception("Error handling %s result for %s", query, client_socket.addr)
+            pending = None
+        if pending is None:
+            done.set_result(None)
+        else:
+            pending.add_done_callback(lambda _: done.set_result(None))
+
+    def rehash_password(self, username, password, previous):
+        """Hash a password in the background and store it in place of previous."""
+        try:
+            future = self.passwords.hash(password)
+        except HasherBusy:
+            return  # try again at the next login
+        def store(future):
+            if future.exception() is None:
+                self.db_submit('set_password', username, future.result(), previous)
+        future.add_done_callback(store)
+
+    def start_session(self, client_socket, username):
+        """Mark a connection as logged in as username, after a login or resume."""
+        first_session = not self.is_online(username)
+        self.add_session(client_socket, username)
+        if first_session:
+            self.publish('user_online', username=username)
+            # Load the friend list now; clients ask for it right after login
+            self.db_submit('get_friends', username)
+        self.presence.set(username, True)
+        self.scheduler.mark_dirty('presence')
+
+    def db_submit(self, query, *args):
+        """Fire-and-forget write; the in-memory state has already changed."""
+        # Never dropped and never run here, even when the executor is full
+        future = self.db_executor.defer(query, *args)
+        future.add_done_callback(lambda f: f.exception() and log.error(
+            "Database error in %s: %s", query, f.exception()))
+
+    def handle_message(self, client_socket, data):
+        # Log the received data for debugging
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Received message type: %s", data.get('type'))
+            if data.get('type') == 'update_profile':
+                log.debug("Profile update received for user: %s", self.clients.get(client_socket))
+                if 'profile_pic' in data:
+                    pic_length = len(data['profile_pic']) if data['profile_pic'] else 0
+                    log.debug("Profile picture data length: %d", pic_length)
+
+        # Handle different message types
+        if data['type'] == 'hello':
+            # Protocol negotiation: the reply still goes out in the old
+            # framing, everything after it uses the negotiated codec
+            codec = negotiate(data)
+            self.send_to_client(client_socket, hello_reply(codec))
+            client_socket.codec = codec
+            log.debug("Negotiated %s with %s", codec, client_socket.addr)
+
+        elif data['type'] == 'login':
+            username = data['username']
+            password = data['password']
+
+            def login_failed():
+                self.send_to_client(client_socket, {
+                    'type': 'login_response',
+                    'success': False
+                })
+
+            def got_password(stored):
+                if stored is None:
+                    return login_failed()
+                return self.hash_request(client_socket, 'verify', password, stored,
+                                         then=lambda result: checked(stored, *result))
+
+            def checked(stored, matches, needs_rehash):
+                if not matches:
+                    return login_failed()
+                if needs_rehash:
+                    # Plaintext row or old cost settings: store a fresh hash
+                    self.rehash_password(username, password, stored)
+                token, digest = new_resume_token()
+
+                def logged_in(stored_token):
+                    self.start_session(client_socket, username)
+                    if stored_token:
+                        client_socket.session_token = digest
+                    self.send_to_client(client_socket, {
+                        'type': 'login_response',
+                        'success': True,
+                        'username': username,
+                        'resume_token': token if stored_token else None
+                    })
+                    self.send_room_state(client_socket)  # Full room list once, deltas after that
+                    log.info("User %s logged in", username)
+
+                def not_stored(e):
+                    # The login still works, the client just can't resume it
+                    log.error("Could not store resume token for %s: %s", username, e)
+                    return logged_in(False)
+
+                return self.db_request(client_socket, 'create_session', digest, username,
+                                       time.time() + RESUME_TOKEN_TTL,
+                                       then=lambda _: logged_in(True), on_error=not_stored)
+
+            return self.db_request(client_socket, 'get_password', username, then=got_password)
+
+        elif data['type'] == 'resume':
+            # A reconnecting client: the token from its login stands in for the
+            # password, and the session goes back into the room it was in. Each
+            # resume swaps the token for a new one, so a used token is worthless
+            token, digest = new_resume_token()
+
+            def resumed(session):
+                if session is None:
+                    self.send_to_client(client_socket, {
+                        'type': 'resume_response',
+                        'success': False
+                    })
+                    return
+                username, room_id = session
+                self.start_session(client_socket, username)
+                client_socket.session_token = digest
+
+                def rejoined(result):
+                    can_join, _ = result
+                    if can_join:
+                        self.move_to_room(client_socket, room_id)
+                        self.scheduler.mark_dirty('rooms')
+                    self.send_to_client(client_socket, {
+                        'type': 'resume_response',
+                        'success': True,
+                        'username': username,
+                        'room_id': room_id if can_join else None,
+                        'resume_token': token
+                    })
+                    self.send_room_state(client_socket)
+                    log.info("User %s resumed a session", username)
+
+                if room_id is None:
+                    return rejoined((False, None))
+                return self.db_request(client_socket, 'verify_room_rejoin', room_id, username,
+                                       then=rejoined)
+
+            return self.db_request(client_socket, 'resume_session',
+                                   token_digest(str(data.get('token', ''))), digest, then=resumed)
+
+        elif data['type'] == 'update_profile':
+            if client_socket in self.clients:
+                username = self.clients[client_socket]
+                log.debug("Processing profile update for %s", username)
+
+                def updated(_):
+                    # Other nodes drop their cached copy
+                    self.publish('profile_changed', username=username)
+                    # Notify client of successful update
+                    self.send_to_client(client_socket, {
+                        'type': 'profile_updated',
+                        'success': True
+                    })
+                    log.info("Profile updated for %s", username)
+
+                def failed(e):
+                    log.error("Error updating profile for %s: %s", username, e)
+                    self.send_to_client(client_socket, {
+                        'type': 'profile_updated',
+                        'success': False,
+                        'message': str(e)
+                    })
+
+                return self.db_request(
+                    client_socket, 'update_user_profile', username,
+                    data.get('bio', ''), data.get('pronouns', ''), data.get('text_color', '#000000'),
+                    then=updated, on_error=failed
+                )
+            else:
+                log.warning("Profile update from a client that is not logged in")
+
+        elif data['type'] == 'register':
+            username = data['username']
+
+            def registered(success):
+                self.send_to_client(client_socket, {
+                    'type': 'register_response',
+                    'success': success,
+                    'message': 'Registration successful' if success else 'Username already exists'
+                })
+                log.info("Registration %s for %s", 'successful' if success else 'failed', username)
+
+            def failed(e):
+                log.error("Registration error for %s: %s", username, e)
+                self.send_to_client(client_socket, {
+                    'type': 'register_response',
+                    'success': False,
+                    'message': f'Registration failed: {str(e)}'
+                })
 
-                elif data['type'] == 'update_profile':
-                    if client_socket in self.clients:
-                        try:
-                            username = self.clients[client_socket]
-                            print(f"Processing profile update for {username}")
-                            
-                            # Update the profile
-                            self.db.update_user_profile(
-                                username,
-                                bio=data.get('bio', ''),
-                                pronouns=data.get('pronouns', ''),
-                                text_color=data.get('text_color', '#000000')
-                            )
-                            
-                            # Notify client of successful update
-                            response = {
-                                'type': 'profile_updated',
-                                'success': True
-                            }
-                            self.send_to_client(client_socket, response)
-                            print(f"Profile updated successfully for {username}")
-                            
-                        except Exception as e:
-                            print(f"Error updating profile: {e}")
-                            error_response = {
-                                'type': 'profile_updated',
-                                'success': False,
-                                'message': str(e)
-                            }
-                            self.send_to_client(client_socket, error_response)
+            def hashed(password_hash):
+                return self.db_request(client_socket, 'add_user', username, password_hash,
+                                       then=registered, on_error=failed)
+
+            return self.hash_request(client_socket, 'hash', data['password'],
+                                     then=hashed, on_error=failed)
+
+        elif data['type'] == 'create_room':
+            if client_socket not in self.clients:
+                self.send_to_client(client_socket, {
+                    'type': 'error',
+                    'message': 'Must be logged in to create rooms'
+                })
+                return
+
+            username = self.clients[client_socket]
+            room_name = data['room_name']
+            room_type = data.get('room_type', 'public')
+            description = data.get('description')
+
+            def created(room_id):
+                room = self.make_room_info(
+                    room_id, room_name, username, room_type, description, [username]
+                )
+                self.rooms[room_id] = set()
+                self.directory.add_room(room)
+                self.publish('room_added', room=dict(room))
+                self.move_to_room(client_socket, room_id)
+
+                # Send confirmation to the client
+                self.send_to_client(client_socket, {
+                    'type': 'room_created',
+                    'room_id': room_id,
+                    'room_name': room_name
+                })
+
+                # Tell all clients about the new room
+                self.scheduler.mark_dirty('rooms')
+                log.info("Room created: %s by %s", room_name, username)
+
+            def failed(e):
+                log.error("Error creating room %s: %s", room_name, e)
+                self.send_to_client(client_socket, {
+                    'type': 'error',
+                    'message': f'Failed to create room: {str(e)}'
+                })
+
+            return self.db_request(client_socket, 'create_room', room_name, username,
+                                   room_type, data.get('password'), description,
+                                   then=created, on_error=failed)
+
+        elif data['type'] == 'join_room':
+            room_id = data['room_id']
+            username = self.clients[client_socket]
+
+            def access_checked(result):
+                can_join, error_message = result
+                if not can_join:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': error_message
+                    })
+                    return
+
+                # Move this session out of its previous room and into the new one
+                self.move_to_room(client_socket, room_id)
+                self.send_to_client(client_socket, {
+                    'type': 'room_joined',
+                    'room_id': room_id
+                })
+                # Broadcast the new user counts
+                self.scheduler.mark_dirty('rooms')
+                log.debug("User %s joined room %s", username, room_id)
+
+            return self.db_request(client_socket, 'verify_room_access', room_id, username,
+                                   data.get('password'), then=access_checked)
+
+        elif data['type'] == 'add_moderator':
+            room_id = data['room_id']
+            target_user = data['username']
+            username = self.clients[client_socket]
+
+            def added(result):
+                success, message = result
+                if success:
+                    room = self.directory.get(room_id)
+                    if room is not None:
+                        moderators = room['moderators'] + [target_user]
+                        self.directory.set_moderators(room_id, moderators)
+                        self.publish('moderators_changed', room_id=room_id, moderators=moderators)
+                        self.scheduler.mark_dirty('rooms')
+                    self.send_to_client(client_socket, {
+                        'type': 'success',
+                        'message': f'Added {target_user} as moderator'
+                    })
+                else:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': message
+                    })
+
+            return self.db_request(client_socket, 'add_room_moderator', room_id, target_user, username,
+                                   then=added)
+
+        elif data['type'] == 'ban_user':
+            room_id = data['room_id']
+            target_user = data['username']
+            username = self.clients[client_socket]
+            reason = data.get('reason')
+
+            def banned(result):
+                success, message = result
+                if success:
+                    # Remove user from room if they're in it
+                    if room_id in self.rooms:
+                        self.remove_user_from_room(target_user, room_id)
+                        self.scheduler.mark_dirty('rooms')
+                    self.publish('kick', room_id=room_id, username=target_user)
+                    # Notify the banned user
+                    self.notify_user(target_user, {
+                        'type': 'banned',
+                        'room_id': room_id,
+                        'reason': reason
+                    })
+                    self.send_to_client(client_socket, {
+                        'type': 'success',
+                        'message': f'Banned {target_user} from room'
+                    })
+                else:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': message
+                    })
+
+            return self.db_request(client_socket, 'ban_user', room_id, target_user, username, reason,
+                                   then=banned)
+
+        elif data['type'] == 'send_friend_request':
+            from_user = self.clients[client_socket]
+            to_user = data['username']
+
+            def sent(result):
+                success, message = result
+                if success:
+                    self.publish('friends_changed', usernames=[from_user, to_user])
+                    # Notify the recipient if they're online
+                    self.notify_user(to_user, {
+                        'type': 'friend_request',
+                        'from_user': from_user
+                    })
+                    self.send_to_client(client_socket, {
+                        'type': 'success',
+                        'message': f'Friend request sent to {to_user}'
+                    })
+                else:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': message
+                    })
+
+            def checked(exists):
+                # Check if user exists
+                if not exists:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': f'User {to_user} does not exist'
+                    })
+                    return
+                return self.db_request(client_socket, 'send_friend_request', from_user, to_user,
+                                       then=sent)
+
+            return self.db_request(client_socket, 'user_exists', to_user, then=checked)
+
+        elif data['type'] == 'accept_friend_request':
+            to_user = self.clients[client_socket]
+            from_user = data['username']
+
+            def accepted(success):
+                if success:
+                    self.publish('friends_changed', usernames=[from_user, to_user])
+                    # Notify both users
+                    self.send_to_client(client_socket, {
+                        'type': 'friend_added',
+                        'username': from_user
+                    })
+                    self.notify_user(from_user, {
+                        'type': 'friend_added',
+                        'username': to_user
+                    })
+                else:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': 'Could not accept friend request'
+                    })
+
+            return self.db_request(client_socket, 'accept_friend_request', from_user, to_user,
+                                   then=accepted)
+
+        elif data['type'] == 'get_friends':
+            username = self.clients[client_socket]
+
+            def got_friends(friends):
+                # Convert friends to list of [username, status] pairs
+                friend_list = []
+                for friend, friendship in friends:
+                    if friendship == 'pending':
+                        status = 'pending'
                     else:
-                        print("Client not found in connected clients")
+                        status = 'online' if self.is_online_anywhere(friend) else 'offline'
+                    friend_list.append([friend, status])
+                self.send_to_client(client_socket, {
+                    'type': 'friends_list',
+                    'friends': friend_list
+                })
 
-                elif data['type'] == 'register':
-                    try:
-                        success = self.db.add_user(data['username'], data['password'])
-                        self.send_to_client(client_socket, {
-                            'type': 'register_response',
-                            'success': success,
-                            'message': 'Registration successful' if success else 'Username already exists'
-                        })
-                        print(f"Registration {'successful' if success else 'failed'} for {data['username']}")
-                    except Exception as e:
-                        print(f"Registration error: {e}")
-                        self.send_to_client(client_socket, {
-                            'type': 'register_response',
-                            'success': False,
-                            'message': f'Registration failed: {str(e)}'
-                        })
+            def failed(e):
+                log.error("Error getting friends list for %s: %s", username, e)
+                self.send_to_client(client_socket, {
+                    'type': 'error',
+                    'message': 'Failed to get friends list'
+                })
+
+            return self.db_request(client_socket, 'get_friends', username,
+                                   then=got_friends, on_error=failed)
 
-                elif data['type'] == 'create_room':
-                    try:
-                        if client_socket not in self.clients:
+        elif data['type'] == 'get_profile':
+            target_username = data['username']
+            log.debug("Getting profile data for user: %s", target_username)
+
+            def got_profile(profile):
+                if profile:
+                    bio, pronouns, text_color = profile
+                else:
+                    log.debug("No profile found for user: %s", target_username)
+                    bio, pronouns, text_color = '', '', '#000000'
+                self.send_to_client(client_socket, {
+                    'type': 'profile_data',
+                    'username': target_username,
+                    'bio': bio or '',
+                    'pronouns': pronouns or '',
+                    'text_color': text_color or '#000000'
+                })
+
+            def failed(e):
+                log.error("Error getting profile for %s: %s", target_username, e)
+                self.send_to_client(client_socket, {
+                    'type': 'error',
+                    'message': 'Failed to get user profile'
+                })
+
+            return self.db_request(client_socket, 'get_user_profile', target_username,
+                                   then=got_profile, on_error=failed)
+
+        elif data['type'] == 'message':
+            if client_socket in self.clients:
+                username = self.clients[client_socket]
+                room_id = data['room_id']
+                content = data['content'].strip()
+                
+                if not content:
+                    return
+                    
+                if self.connection_rooms.get(client_socket) == room_id:
+                    # Get user's text color. This stays inline rather than going
+                    # through the executor: it is almost always a cache hit, and
+                    # the hot path shouldn't pay for a thread handoff
+                    profile = self.db.get_user_profile(username)
+                    text_color = profile[2] if profile else '#000000'
+                    payload_log.debug("Message from %s in room %s: %s", username, room_id, content)
+                    if self.broker is not None:
+                        # The broker numbers it across the cluster; it comes back
+                        # as a room_message event and is stored and sent from there
+                        message_id, floor = self.history.new_message(room_id)
+                        message = {
+                            'type': 'message',
+                            'id': message_id,
+                            'room_id': room_id,
+                            'username': username,
+                            'content': content,
+                            'text_color': text_color,
+                            'sent_at': time.time()
+                        }
+                        if not self.broker.sequence(room_id, message, floor):
                             self.send_to_client(client_socket, {
                                 'type': 'error',
-                                'message': 'Must be logged in to create rooms'
+                                'message': 'Chat is reconnecting, please try again'
                             })
-                            continue
-
-                        username = self.clients[client_socket]
-                        room_id = self.db.create_room(
-                            data['room_name'],
-                            username,
-                            room_type=data.get('room_type', 'public'),
-                            password=data.get('password'),
-                            description=data.get('description')
-                        )
-                        self.rooms[room_id] = set([username])
-                        
-                        # Send confirmation to the client
-                        self.send_to_client(client_socket, {
-                            'type': 'room_created',
-                            'room_id': room_id,
-                            'room_name': data['room_name']
-                        })
-                        
-                        # Broadcast updated room state to all clients
-                        self.broadcast_room_state()
-                        print(f"Room created: {data['room_name']} by {username}")
-                    except Exception as e:
-                        print(f"Error creating room: {e}")
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': f'Failed to create room: {str(e)}'
-                        })
+                        return
 
-                elif data['type'] == 'join_room':
-                    room_id = data['room_id']
-                    username = self.clients[client_socket]
-                    password = data.get('password')
+                    # Queued for storage; the broadcast doesn't wait for the disk
+                    message_id, seq, sent_at = self.history.append(room_id, username, content, text_color)
+                    
+                    message = {
+                        'type': 'message',
+                        'id': message_id,
+                        'seq': seq,
+                        'room_id': room_id,
+                        'username': username,
+                        'content': content,
+                        'text_color': text_color,
+                        'sent_at': sent_at
+                    }
+                    self.broadcast_message(message, room_id)  # Send as dict, not JSON string
+                else:
+                    log.debug("User %s not in room %s", username, room_id)
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': 'You are not in this room'
+                    })
 
-                    # Verify access
-                    can_join, error_message = self.db.verify_room_access(room_id, username, password)
-                    if not can_join:
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': error_message
-                        })
-                        continue
-
-                    # Remove user from other rooms
-                    for room_users in self.rooms.values():
-                        room_users.discard(username)
-                    # Add to new room
-                    if room_id not in self.rooms:
-                        self.rooms[room_id] = set()
-                    self.rooms[room_id].add(username)
-                    # Broadcast updated room state
-                    self.broadcast_room_state()
-                    print(f"User {username} joined room {room_id}")
-
-                elif data['type'] == 'add_moderator':
-                    room_id = data['room_id']
-                    target_user = data['username']
-                    username = self.clients[client_socket]
-                    success, message = self.db.add_room_moderator(room_id, target_user, username)
-                    if success:
-                        self.broadcast_room_state()
-                        self.send_to_client(client_socket, {
-                            'type': 'success',
-                            'message': f'Added {target_user} as moderator'
-                        })
-                    else:
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': message
-                        })
+        elif data['type'] == 'get_history':
+            # Older messages, a page at a time: pass the oldest seq you have as 'before'.
+            # A reconnecting client passes the newest seq it has as 'after' instead,
+            # and gets what it missed, oldest first
+            if client_socket in self.clients:
+                room_id = data['room_id']
+                if self.connection_rooms.get(client_socket) != room_id:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': 'You are not in this room'
+                    })
+                    return
+                limit = max(1, min(int(data.get('limit', HISTORY_PAGE_SIZE)), MAX_HISTORY_PAGE))
+                after = data.get('after')
 
-                elif data['type'] == 'ban_user':
-                    room_id = data['room_id']
-                    target_user = data['username']
-                    username = self.clients[client_socket]
-                    reason = data.get('reason')
-                    success, message = self.db.ban_user(room_id, target_user, username, reason)
-                    if success:
-                        # Remove user from room if they're in it
-                        if room_id in self.rooms:
-                            self.rooms[room_id].discard(target_user)
-                            self.broadcast_room_state()
-                        # Notify the banned user
-                        for client, name in self.clients.items():
-                            if name == target_user:
-                                self.send_to_client(client, {
-                                    'type': 'banned',
-                                    'room_id': room_id,
-                                    'reason': reason
-                                })
-                                break
-                        self.send_to_client(client_socket, {
-                            'type': 'success',
-                            'message': f'Banned {target_user} from room'
-                        })
-                    else:
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': message
-                        })
+                def got_missed(rows):
+                    self.send_to_client(client_socket, {
+                        'type': 'history',
+                        'room_id': room_id,
+                        'after': after,
+                        'messages': [message_to_dict(row) for row in rows[:limit]],
+                        'has_more': len(rows) > limit
+                    })
 
-                elif data['type'] == 'send_friend_request':
-                    from_user = self.clients[client_socket]
-                    to_user = data['username']
-                    
-                    # Check if user exists
-                    if not self.db.user_exists(to_user):
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': f'User {to_user} does not exist'
-                        })
-                        continue
-                        
-                    success, message = self.db.send_friend_request(from_user, to_user)
-                    if success:
-                        # Notify the recipient if they're online
-                        for client, name in self.clients.items():
-                            if name == to_user:
-                                self.send_to_client(client, {
-                                    'type': 'friend_request',
-                                    'from_user': from_user
-                                })
-                                break
-                        self.send_to_client(client_socket, {
-                            'type': 'success',
-                            'message': f'Friend request sent to {to_user}'
-                        })
-                    else:
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': message
-                        })
+                if after is not None:
+                    return self.db_request(client_socket, self.history.since, room_id, int(after),
+                                           limit + 1, then=got_missed)
 
-                elif data['type'] == 'accept_friend_request':
-                    to_user = self.clients[client_socket]
-                    from_user = data['username']
-                    if self.db.accept_friend_request(from_user, to_user):
-                        # Notify both users
-                        self.send_to_client(client_socket, {
-                            'type': 'friend_added',
-                            'username': from_user
-                        })
-                        for client, name in self.clients.items():
-                            if name == from_user:
-                                self.send_to_client(client, {
-                                    'type': 'friend_added',
-                                    'username': to_user
-                                })
-                                break
-                    else:
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': 'Could not accept friend request'
-                        })
+                def got_page(rows):
+                    self.send_to_client(client_socket, {
+                        'type': 'history',
+                        'room_id': room_id,
+                        'messages': [message_to_dict(row) for row in reversed(rows[:limit])],
+                        'has_more': len(rows) > limit
+                    })
 
-                elif data['type'] == 'get_friends':
-                    username = self.clients[client_socket]
-                    try:
-                        friends = self.db.get_friends(username)
-                        # Convert friends to list of [username, status] pairs
-                        friend_list = []
-                        for friend in friends:
-                            status = 'online' if friend in self.clients.values() else 'offline'
-                            friend_list.append([friend, status])
-                        self.send_to_client(client_socket, {
-                            'type': 'friends_list',
-                            'friends': friend_list
-                        })
-                    except Exception as e:
-                        print(f"Error getting friends list: {e}")
-                        self.send_to_client(client_socket, {
-                            'type': 'error',
-                            'message': 'Failed to get friends list'
-                        })
+                # One extra row tells us whether there is another page
+                return self.db_request(client_socket, self.history.page, room_id, data.get('before'),
+                                       limit + 1, then=got_page)
 
-                elif data['type'] == 'get_profile':
-                    target_username = data['username']
-                    try:
-                        print(f"Getting profile data for user: {target_username}")
-                        profile = self.db.get_user_profile(target_username)
-                        if profile:
-                            bio, pronouns, text_color = profile
-                            response = {
-                                'type': 'profile_data',
-                                'username': target_username,
-                                'bio': bio or '',
-                                'pronouns': pronouns or '',
-                                'text_color': text_color or '#000000'
-                            }
-                        else:
-                            print(f"No profile found for user: {target_username}")
-                            response = {
-                                'type': 'profile_data',
-                                'username': target_username,
-                                'bio': '',
-                                'pronouns': '',
-                                'text_color': '#000000'
-                            }
-                        print("Sending profile data response")
-                        self.send_to_client(client_socket, response)
-                        print(f"Sent profile data for user: {target_username}")
-                    except Exception as e:
-                        print(f"Error getting profile: {e}")
+        elif data['type'] == 'search_messages':
+            # Ranked full-text search: one room if room_id is given, otherwise
+            # the public rooms plus the room this session is in
+            if client_socket in self.clients:
+                if not self.db.search_available:
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': 'Search is not available on this server'
+                    })
+                    return
+                query = search_query(data.get('query', ''))
+                room_id = data.get('room_id')
+                current_room = self.connection_rooms.get(client_socket)
+                if room_id is not None and room_id != current_room:
+                    room = self.directory.get(room_id)
+                    if room is None or room['type'] != 'public':
                         self.send_to_client(client_socket, {
                             'type': 'error',
-                            'message': 'Failed to get user profile'
+                            'message': 'You are not in this room'
                         })
+                        return
+                offset = max(0, int(data.get('offset', 0)))
+                limit = max(1, min(int(data.get('limit', SEARCH_PAGE_SIZE)), MAX_SEARCH_PAGE))
 
-                elif data['type'] == 'message':
-                    if client_socket in self.clients:
-                        username = self.clients[client_socket]
-                        room_id = data['room_id']
-                        content = data['content'].strip()
-                        
-                        if not content:
-                            continue
-                            
-                        if room_id in self.rooms and username in self.rooms[room_id]:
-                            # Get user's text color
-                            profile = self.db.get_user_profile(username)
-                            text_color = profile[2] if profile else '#000000'
-                            
-                            message = {
-                                'type': 'message',
-                                'room_id': room_id,
-                                'username': username,
-                                'content': content,
-                                'text_color': text_color
-                            }
-                            print(f"Broadcasting message from {username} in room {room_id}: {content}")
-                            self.broadcast_message(message, room_id)  # Send as dict, not JSON string
-                        else:
-                            print(f"User {username} not in room {room_id}")
-                            self.send_to_client(client_socket, {
-                                'type': 'error',
-                                'message': 'You are not in this room'
-                            })
+                def found(rows):
+                    self.send_to_client(client_socket, {
+                        'type': 'search_results',
+                        'query': data.get('query', ''),
+                        'room_id': room_id,
+                        'offset': offset,
+                        'messages': [message_to_dict(row) for row in rows[:limit]],
+                        'has_more': len(rows) > limit
+                    })
 
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error from {addr}: {e}")
-                continue
-            except Exception as e:
-                print(f"Error handling client {addr}: {e}")
-                break
+                def failed(e):
+                    if isinstance(e, TimeoutError):
+                        message = 'Too many messages match; add more words or search one room'
+                    else:
+                        log.error("Error searching messages for %r: %s", query, e)
+                        message = 'Search failed'
+                    self.send_to_client(client_socket, {
+                        'type': 'error',
+                        'message': message
+                    })
+
+                if query is None:
+                    found([])
+                elif room_id is not None:
+                    return self.db_request(client_socket, 'search_messages', query, room_id, False,
+                                           offset, limit + 1, then=found, on_error=failed)
+                else:
+                    return self.db_request(client_socket, 'search_messages', query, current_room, True,
+                                           offset, limit + 1, then=found, on_error=failed)
 
-        self.remove_client(client_socket)
+        elif data['type'] == 'get_room_state':
+            # Clients ask for a fresh snapshot when they notice a gap in the deltas
+            if client_socket in self.clients:
+                self.send_room_state(client_socket)
+
+        elif data['type'] == 'get_stats':
+            if client_socket in self.clients:
+                self.send_to_client(client_socket, {
+                    'type': 'stats',
+                    'outbound_queues': self.get_queue_stats(),
+                    'broadcasts': self.scheduler.stats(),
+                    'broker': self.broker.stats() if self.broker is not None else None,
+                    'profile_cache': self.db.profile_cache_stats(),
+                    'friend_cache': self.db.friend_cache_stats(),
+                    'history': self.history.stats(),
+                    'database': self.db_executor.stats(),
+                    'presence': self.presence.stats(),
+                    'password_hashing': self.passwords.stats()
+                })
 
     def remove_empty_rooms(self):
+        with self.index_lock:
+            empty_rooms = [room_id for room_id, room in self.directory.rooms.items()
+                           if room['user_count'] == 0]
+        if not empty_rooms:
+            return
+        # A room someone can still resume into is kept; it goes at a later
+        # check once their session has expired
+        future = self.db_executor.defer('rooms_with_sessions', empty_rooms)
+        future.add_done_callback(lambda f: self.on_sessions_checked(empty_rooms, f))
+
+    def on_sessions_checked(self, empty_rooms, future):
+        # Called on an executor thread; in asyncio mode hop onto the loop
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.delete_empty_rooms, empty_rooms, future)
+        else:
+            self.delete_empty_rooms(empty_rooms, future)
+
+    def delete_empty_rooms(self, empty_rooms, future):
         try:
-            # Get all rooms from database
-            db_rooms = self.db.get_rooms(include_private=True)
-            for room in db_rooms:
-                room_id = room[0]
-                # Check if room exists in memory and has zero users
-                if room_id in self.rooms and len(self.rooms[room_id]) == 0:
-                    print(f"Deleting empty room {room_id}")
-                    # Delete room from database
-                    self.db.delete_room(room_id)
-                    # Remove from memory
-                    del self.rooms[room_id]
-            
-            # Broadcast updated room state to all clients
-            if self.rooms:  # Only broadcast if there are rooms
-                self.broadcast_room_state()
-        except Exception as e:
-            print(f"Error removing empty rooms: {e}")
+            resumable = future.result()
+            deleted = False
+            for room_id in empty_rooms:
+                if room_id in resumable:
+                    continue
+                room = self.directory.get(room_id)
+                if room is None or room['user_count']:
+                    continue  # Someone joined in the meantime
+                log.info("Deleting empty room %s", room_id)
+                # Delete room from database
+                self.db_submit('delete_room', room_id)
+                # Remove from memory
+                with self.index_lock:
+                    self.rooms.pop(room_id, None)
+                    self.directory.remove_room(room_id)
+                self.publish('room_removed', room_id=room_id)
+                deleted = True
+            if deleted:
+                self.scheduler.mark_dirty('rooms')
+        except Exception:
+            log.exception("Error removing empty rooms")
 
     def remove_client(self, client_socket):
-        if client_socket in self.clients:
-            username = self.clients[client_socket]
-            self.db.update_user_status(username, False)
-            del self.clients[client_socket]
-            # Remove user from all rooms
-            for room_users in self.rooms.values():
-                room_users.discard(username)
-            self.broadcast_online_users()
+        if client_socket.slow_consumer:
+            self.slow_consumers += 1
+            log.warning("Disconnected slow consumer %s", client_socket.addr)
+        username = self.remove_session(client_socket)
+        if username is not None:
+            # Other sessions of the same user keep them online
+            if not self.is_online(username):
+                self.publish('user_offline', username=username)
+                self.db.drop_friends(username)
+                if not self.is_online_anywhere(username):
+                    self.presence.set(username, False)
+            self.scheduler.mark_dirty('presence')
             self.remove_empty_rooms()  # Check for empty rooms after user leaves
-            self.broadcast_room_state()  # Update room state to reflect user counts
+            self.scheduler.mark_dirty('rooms')  # New user counts
         client_socket.close()
 
-    def run(self):
-        print("Server starting...")
+    def run(self, mode='threaded'):
+        if mode == 'asyncio':
+            self.run_async()
+            return
+
+        log.info("Server starting...")
+        self.start_broker()
         try:
             while True:
-                print("Waiting for connections...")
+                log.debug("Waiting for connections...")
                 client_socket, addr = self.server_socket.accept()
-                print(f"New connection from {addr}")
+                log.info("New connection from %s", addr)
                 thread = threading.Thread(target=self.handle_client,
                                        args=(client_socket, addr))
                 thread.start()
-        except Exception as e:
-            print(f"Server error: {e}")
+        except Exception:
+            log.exception("Server error")
         finally:
             self.server_socket.close()
-            print("Server shutdown")
+            self.db_executor.close()
+            self.passwords.close()
+            self.presence.close()
+            self.history.close()  # write out queued messages
+            log.info("Server shutdown")
+
+    def terminate(self, signum=None, frame=None):
+        """SIGTERM handler: store queued messages, then exit without waiting for clients."""
+        self.passwords.close()
+        self.presence.close()
+        self.history.close()
+        if self.log_listener is not None:
+            self.log_listener.stop()
+        os._exit(0)
+
+    def run_async(self):
+        log.info("Server starting (asyncio mode)...")
+        try:
+            asyncio.run(self._serve_async())
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            log.exception("Server error")
+        finally:
+            self.server_socket.close()
+            self.db_executor.close()
+            self.passwords.close()
+            self.presence.close()
+            self.history.close()  # write out queued messages
+            log.info("Server shutdown")
+
+    async def _serve_async(self):
+        # All connections share one event loop instead of one thread each
+        self.loop = asyncio.get_running_loop()
+        self.scheduler.use_event_loop(self.loop)
+        self.start_broker()
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket)
+        async with server:
+            log.debug("Waiting for connections...")
+            await server.serve_forever()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--host', default='10.0.0.38')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help='threaded: one thread per connection; asyncio: single event loop')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='maximum frames queued for a single client')
+    parser.add_argument('--queue-policy', choices=QUEUE_POLICIES, default=DROP_OLDEST,
+                        help='what to do when a client falls behind and its queue fills up')
+    parser.add_argument('--broadcast-tick', type=float, default=0.1,
+                        help='seconds between presence/room list broadcasts (0 sends every change at once)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes sharing the port via SO_REUSEPORT (Linux/BSD)')
+    parser.add_argument('--broker', default=None,
+                        help='join a cluster through the broker at tcp://host:port or unix:///path')
+    parser.add_argument('--broker-secret', default=os.environ.get(SECRET_ENV),
+                        help=f'secret shared by the broker and every node (default: ${SECRET_ENV})')
+    parser.add_argument('--node-id', default=f'{socket.gethostname()}-{os.getpid()}',
+                        help='name of this server in the cluster (must be unique)')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO')
+    parser.add_argument('--rebuild-search-index', action='store_true',
+                        help='re-index all stored messages for search, then exit')
+    parser.add_argument('--hash-passwords', action='store_true',
+                        help='hash any passwords still stored in plaintext, then exit')
+    parser.add_argument('--log-payloads', action='store_true',
+                        help='log the content of every chat message (slow; for debugging only)')
+    args = parser.parse_args()
+    if args.broker and not args.broker_secret:
+        parser.error(f'--broker needs --broker-secret or ${SECRET_ENV}')
+    return args
+
+def run_workers(args):
+    """Fork args.workers servers on one port, linked by a broker.
+
+    Without --broker the parent process runs a hub on a Unix socket for the
+    workers; with --broker every worker joins that cluster as its own node.
+    """
+    hub = None
+    address = args.broker
+    secret = args.broker_secret
+    if address is None:
+        address = 'unix://' + os.path.join(tempfile.gettempdir(), f'chatroom-{args.port}.sock')
+        # Only the forked workers know it; other local users can reach the socket
+        secret = secrets.token_urlsafe(32)
+        hub = BrokerHub(address, secret)
+    children = []
+    for i in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            if hub is not None:
+                hub.listener.close()  # the parent keeps serving the hub
+            # The parent's log writer thread doesn't survive the fork
+            listener = setup_logging(args.log_level, args.log_payloads)
+            code = 0
+            try:
+                server = ChatServer(args.host, args.port, args.queue_size, args.queue_policy,
+                                    args.broadcast_tick, reuse_port=True,
+                                    broker=BrokerClient(address, f'{args.node_id}/worker-{i}', secret))
+                server.log_listener = listener
+                signal.signal(signal.SIGTERM, server.terminate)
+                log.info("Worker %d (pid %d) initialized successfully", i, os.getpid())
+                server.run(args.mode)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                log.exception("Worker %d failed", i)
+                code = 1
+            listener.stop()  # os._exit skips the writer thread; flush what's queued
+            os._exit(code)
+        children.append(pid)
+
+    if hub is not None:
+        threading.Thread(target=hub.serve_forever, daemon=True).start()
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    finally:
+        if hub is not None:
+            hub.close()
+        log.info("All workers stopped")
 
 if __name__ == "__main__":
+    args = parse_args()
+    listener = setup_logging(args.log_level, args.log_payloads)
+    if args.rebuild_search_index:
+        db = Database()
+        if db.search_available:
+            db.rebuild_search_index()
+            log.info("Search index rebuilt")
+        db.close()
+        listener.stop()
+        sys.exit(0)
+    if args.hash_passwords:
+        # Users are also migrated one by one as they log in; this does the rest
+        db = Database()
+        count = 0
+        for username, password in db.get_passwords():
+            if not is_hashed(password):
+                count += db.set_password(username, hash_password(password), password)
+        log.info("Hashed %d plaintext passwords", count)
+        db.close()
+        listener.stop()
+        sys.exit(0)
+    if args.broker is None:
+        # Nobody is online before we start accepting; clears flags left by a
+        # crash. Nodes joining a shared broker leave them alone, since other
+        # nodes may have users online
+        db = Database()
+        db.reset_online_status()
+        db.close()
+    if args.workers > 1:
+        run_workers(args)
+        listener.stop()
+        sys.exit(0)
     try:
-        server = ChatServer()
-        print("Server initialized successfully")
-        server.run()
-    except Exception as e:
-        print(f"Failed to start server: {e}") 
\ No newline at end of file
+        broker = BrokerClient(args.broker, args.node_id, args.broker_secret) if args.broker else None
+        server = ChatServer(args.host, args.port, args.queue_size, args.queue_policy,
+                            args.broadcast_tick, broker=broker)
+        server.log_listener = listener
+        signal.signal(signal.SIGTERM, server.terminate)
+        log.info("Server initialized successfully")
+        server.run(args.mode)
+    except Exception:
+        log.exception("Failed to start server")
+    listener.stop()